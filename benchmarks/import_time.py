@@ -0,0 +1,30 @@
+"""
+Times importing metadsl_all in fresh interpreters, and checks that it doesn't load the
+dependencies which are only needed for printing, plotting or displaying.
+"""
+import statistics
+import subprocess
+import sys
+
+N = 10
+MODULE = "metadsl_all"
+LAZY_MODULES = ["black", "igraph", "IPython", "jsonschema"]
+
+code = f"""
+import sys, time
+start = time.perf_counter()
+import {MODULE}
+print(time.perf_counter() - start)
+print(" ".join(m for m in {LAZY_MODULES!r} if m in sys.modules))
+"""
+
+times = []
+for _ in range(N):
+    seconds, loaded = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    ).stdout.split("\n", 1)
+    times.append(float(seconds))
+
+print(f"import {MODULE}")
+print(f"min: {min(times):.3f}s median: {statistics.median(times):.3f}s")
+print(f"lazy modules loaded: {loaded.strip() or 'none'}")
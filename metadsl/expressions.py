@@ -4,7 +4,9 @@ import dataclasses
 import itertools
 import types
 import typing
+import weakref
 
+from .dict_tools import HashableMapping
 from .typing_tools import *
 
 __all__ = [
@@ -14,6 +16,9 @@ __all__ = [
     "IteratedPlaceholder",
     "create_iterated_placeholder",
     "clone_expression",
+    "map_expression",
+    "toggle_interning",
+    "toggle_immutable_expressions",
 ]
 
 T = typing.TypeVar("T")
@@ -37,11 +42,20 @@ class Expression(GenericCheck):
     The return type of the function, inferred by replacing the typevars in and with these args and kwargs,
     should match the type of the expression. If the return type of the function is not subclass of expression,
     then this should be a PlaceholderExpression of that type.
+
+    If the args are a tuple (and the kwargs a `HashableMapping`), the expression is frozen and
+    is never mutated in place, see `toggle_immutable_expressions`.
     """
 
     function: typing.Callable
-    args: typing.List[object]
-    kwargs: typing.Dict[str, object]
+    args: typing.Union[typing.List[object], typing.Tuple[object, ...]]
+    kwargs: typing.Union[typing.Dict[str, object], HashableMapping[str, object]]
+    # Cached result of `_structural_hash`, has to be reset to None when the args or kwargs are mutated
+    _hash: typing.Optional[int] = dataclasses.field(default=None, init=False)
+    # Cached result of `_frozen_without_typevars`, which is only set on frozen expressions
+    _without_typevars: typing.Optional[bool] = dataclasses.field(
+        default=None, init=False
+    )
 
     def __str__(self):
         arg_strings = (str(arg) for arg in self.args)
@@ -57,7 +71,7 @@ class Expression(GenericCheck):
 
     @property
     def _type_str(self):
-        t = get_type(self)
+        t = self._type
         if isinstance(t, typing._GenericAlias):  # type: ignore
             return repr(t)
         return typing._type_repr(t)  # type: ignore
@@ -71,36 +85,148 @@ class Expression(GenericCheck):
         self: T_expression,
         fn: typing.Callable[[T], T],
         function_fn: typing.Callable[[CALLABLE], CALLABLE] = None,
-        type_fn: typing.Callable[
-            [typing.Type[T_expression]], typing.Type[T_expression]
+        type_fn: typing.Optional[
+            typing.Callable[[typing.Type[T_expression]], typing.Type[T_expression]]
         ] = None,
     ) -> T_expression:
         """
         Map a function on all args and recreate function.
 
         """
-        new_expr = type(self)(
+        new_expr = self._with_children(
+            [fn(typing.cast(T, arg)) for arg in self.args],
+            {k: fn(typing.cast(T, v)) for k, v in self.kwargs.items()},
             function=function_fn(self.function) if function_fn else self.function,  # type: ignore
-            args=[fn(typing.cast(T, arg)) for arg in self.args],
-            kwargs={k: fn(typing.cast(T, v)) for k, v in self.kwargs.items()},
         )
-        # copy generic class
-        if hasattr(self, "__orig_class__"):
-            new_expr.__orig_class__ = (  # type: ignore
-                type_fn(self.__orig_class__) if type_fn else self.__orig_class__  # type: ignore
-            )
+        if type_fn is not None and self._type is not type(self):
+            new_expr._type = type_fn(self._type)
 
         return new_expr
 
+    @property
+    def _frozen(self) -> bool:
+        """
+        Whether this expression was created with immutable args and kwargs.
+        """
+        return isinstance(self.args, tuple)
+
+    def _with_children(
+        self: T_expression,
+        args: typing.Iterable[object],
+        kwargs: typing.Mapping[str, object],
+        function: typing.Optional[typing.Callable] = None,
+    ) -> T_expression:
+        """
+        Returns a new expression of the same type, with these args and kwargs.
+
+        The new expression is frozen if this one is or if immutable expressions are turned on.
+        """
+        frozen = _IMMUTABLE or self._frozen
+        new_expr = type(self)(
+            function=self.function if function is None else function,
+            args=tuple(args) if frozen else list(args),
+            kwargs=HashableMapping(kwargs) if frozen else dict(kwargs),
+        )
+        # copy generic class
+        if self._type is not type(self):
+            new_expr._type = self._type
+        return new_expr
+
     def __eq__(self, value) -> bool:
+        if self is value:
+            return True
         if not isinstance(value, Expression):
             return False
+        if self._structural_hash() != value._structural_hash():
+            return False
 
-        return (
-            self.function == value.function
-            and self.args == value.args
-            and self.kwargs == value.kwargs
-        )
+        # Compare with an explicit stack instead of recursing, so that deep expressions
+        # don't hit the recursion limit. Pairs that were already compared are skipped, so
+        # shared nodes are only compared once.
+        compared: typing.Set[typing.Tuple[int, int]] = set()
+        stack: typing.List[typing.Tuple[Expression, Expression]] = [(self, value)]
+        while stack:
+            left, right = stack.pop()
+            if (
+                not left.function == right.function
+                or len(left.args) != len(right.args)
+                or left.kwargs.keys() != right.kwargs.keys()
+            ):
+                return False
+            for left_child, right_child in itertools.chain(
+                zip(left.args, right.args),
+                ((v, right.kwargs[k]) for k, v in left.kwargs.items()),
+            ):
+                if left_child is right_child:
+                    continue
+                if not isinstance(left_child, Expression):
+                    if (
+                        isinstance(right_child, Expression)
+                        or not left_child == right_child
+                    ):
+                        return False
+                    continue
+                if (
+                    not isinstance(right_child, Expression)
+                    or left_child._structural_hash() != right_child._structural_hash()
+                ):
+                    return False
+                key = (id(left_child), id(right_child))
+                if key not in compared:
+                    compared.add(key)
+                    stack.append((left_child, right_child))
+        return True
+
+    def _structural_hash(self) -> int:
+        """
+        Returns a hash of the function, args and kwargs, which is equal for equal expressions.
+
+        It is cached, so that comparing expressions that are not equal doesn't have to walk them.
+        """
+        if self._hash is None:
+            # Hash the uncached descendents bottom up, instead of recursing
+            for expr in _postorder(self, lambda e: e._hash is None):
+                expr._hash = hash(
+                    (
+                        _value_hash(expr.function),
+                        tuple(map(_value_hash, expr.args)),
+                        frozenset((k, _value_hash(v)) for k, v in expr.kwargs.items()),
+                    )
+                )
+        return typing.cast(int, self._hash)
+
+    def _frozen_without_typevars(self) -> bool:
+        """
+        Returns whether this expression and all its descendents are frozen, and none of their
+        types, functions or values refer to typevars. Replacing typevars in it would then
+        rebuild it as it is, so it can be reused instead.
+
+        It is cached like `_structural_hash`, but only on frozen expressions, since they are
+        never mutated.
+        """
+        if not self._frozen:
+            return False
+        if self._without_typevars is None:
+            for expr in _postorder(
+                self, lambda e: e._frozen and e._without_typevars is None
+            ):
+                expr._without_typevars = not (
+                    expr._type is not type(expr) and contains_typevars(expr._type)  # type: ignore
+                ) and all(
+                    child._without_typevars
+                    if isinstance(child, Expression)
+                    else not fn_contains_typevars(child)
+                    for child in itertools.chain(
+                        (expr.function,), expr.args, expr.kwargs.values()
+                    )
+                )
+        return typing.cast(bool, self._without_typevars)
+
+    def __getstate__(self):
+        # Don't pickle the cached hash, since it can differ between processes
+        state = dict(self.__dict__)
+        state.pop("_hash", None)
+        return state
 
     @classmethod
     def __init_subclass__(cls, wrap_methods=False, **kwargs) -> None:
@@ -118,10 +244,116 @@ class Expression(GenericCheck):
                 )
 
 
+def _value_hash(value: object) -> int:
+    """
+    Hash of an arg or kwarg of an expression, so that equal values have equal hashes.
+    """
+    if isinstance(value, Expression):
+        return value._structural_hash()
+    try:
+        return hash(value)
+    except TypeError:
+        # All unhashable values have the same hash, so they are compared on equality instead
+        return 0
+
+
+def _postorder(
+    expr: Expression, include: typing.Callable[[Expression], bool]
+) -> typing.Iterator[Expression]:
+    """
+    Yields the distinct descendent expressions of `expr` for which `include` is true, and
+    `expr` itself, each after all of its children. Children that are not included are not
+    traversed.
+    """
+    visited: typing.Set[int] = {id(expr)}
+    stack: typing.List[typing.Tuple[Expression, bool]] = [(expr, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if children_done:
+            yield node
+            continue
+        stack.append((node, True))
+        for child in itertools.chain(node.args, node.kwargs.values()):
+            if (
+                isinstance(child, Expression)
+                and id(child) not in visited
+                and include(child)
+            ):
+                visited.add(id(child))
+                stack.append((child, False))
+
+
+def map_expression(
+    value: T,
+    fn: typing.Callable[
+        [Expression, typing.List[object], typing.Dict[str, object]], object
+    ],
+    shortcut: typing.Optional[typing.Callable[[object], object]] = None,
+) -> T:
+    """
+    Rebuilds an expression bottom up, using an explicit stack instead of recursion.
+
+    `fn` is called with each expression and the results for its args and kwargs, and returns
+    the result for that expression. Values that are not expressions are kept as they are.
+
+    If `shortcut` is passed, it is called on each value before its children are visited. If it
+    returns something besides `NotImplemented`, that is the result for that value and its
+    children are not visited.
+
+    Each distinct node is only visited once, so shared nodes are also shared in the result.
+    """
+    results: typing.Dict[int, object] = {}
+    stack: typing.List[typing.Tuple[object, bool]] = [(value, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if children_done:
+            assert isinstance(node, Expression)
+            results[id(node)] = fn(
+                node,
+                [results[id(arg)] for arg in node.args],
+                {k: results[id(v)] for k, v in node.kwargs.items()},
+            )
+            continue
+        if id(node) in results:
+            continue
+        if shortcut:
+            result = shortcut(node)
+            if result is not NotImplemented:
+                results[id(node)] = result
+                continue
+        if not isinstance(node, Expression):
+            results[id(node)] = node
+            continue
+        stack.append((node, True))
+        stack.extend(
+            (child, False)
+            for child in itertools.chain(node.args, node.kwargs.values())
+            if id(child) not in results
+        )
+    return typing.cast(T, results[id(value)])
+
+
 def clone_expression(expr: T) -> T:
-    if isinstance(expr, Expression):
-        return expr._map(clone_expression)  # type: ignore
-    return expr
+    """
+    Returns a copy of the expression, which can be mutated without changing the original.
+
+    Nodes that are shared in the original are also shared in the copy, so the cost is linear
+    in the number of distinct nodes, not in the size of the unfolded tree. Frozen nodes,
+    which only contain frozen nodes, are never mutated and so are not copied.
+    """
+    return map_expression(expr, _clone_node)
+
+
+def _clone_node(
+    expr: Expression, args: typing.List[object], kwargs: typing.Dict[str, object]
+) -> Expression:
+    if (
+        expr._frozen
+        and all(a is b for a, b in zip(args, expr.args))
+        and all(kwargs[k] is v for k, v in expr.kwargs.items())
+    ):
+        return expr
+    return expr._with_children(args, kwargs)
 
 
 class PlaceholderExpression(Expression, OfType[T], typing.Generic[T]):
@@ -147,11 +379,103 @@ def extract_expression_type(t: typing.Type) -> typing.Type[Expression]:
 T_callable = typing.TypeVar("T_callable", bound=typing.Callable)
 
 
+# Mapping of the type, function, and children of an expression to the expression created
+# for them, if interning is turned on.
+_INTERNED: typing.Optional[weakref.WeakValueDictionary] = None
+
+
+def toggle_interning(enabled: bool) -> None:
+    """
+    Turns hash consing of expressions on or off.
+
+    When it is on, creating an expression with the same function and children as one
+    that is still alive returns that same expression, instead of a new one.
+
+    Since these are shared, only frozen expressions are interned, so it only has an effect
+    while immutable expressions are turned on, see `toggle_immutable_expressions`. Mutable
+    ones are mutated in place when replacing their children, which would change every
+    expression they are shared with.
+    """
+    global _INTERNED
+    _INTERNED = weakref.WeakValueDictionary() if enabled else None
+
+
+# Whether new expressions are created frozen, with tuple args and `HashableMapping` kwargs.
+_IMMUTABLE = False
+
+
+def toggle_immutable_expressions(enabled: bool) -> None:
+    """
+    Turns immutable expressions on or off.
+
+    When it is on, expressions are created with tuple args and `HashableMapping` kwargs and are
+    never mutated in place. Since they can be shared safely, creating one does not clone its
+    children and executing it does not copy it. Replacing a child in a graph of them records
+    the replacement in the graph and rebuilds the ancestors of the child, instead of
+    assigning into their args.
+    """
+    global _IMMUTABLE
+    _IMMUTABLE = enabled
+
+
+def _intern_key(value: object) -> typing.Hashable:
+    # Children that are expressions are already interned, so compare them by identity.
+    # The interned parent keeps them alive, so their ids can't be reused while it is in the table.
+    if isinstance(value, Expression):
+        return id(value)
+    key = (type(value), value)
+    try:
+        hash(key)
+    except TypeError:
+        return (id, id(value))
+    return key
+
+
+def _create_expression(
+    tp: typing.Type[T_expression],
+    function: typing.Callable,
+    args: typing.Union[typing.List[object], typing.Tuple[object, ...]],
+    kwargs: typing.Union[typing.Dict[str, object], HashableMapping[str, object]],
+) -> T_expression:
+    """
+    Creates an expression of the type, which can be a generic alias like `PlaceholderExpression[int]`,
+    storing the alias in its `_type`.
+    """
+    cls = getattr(tp, "__origin__", tp)
+    expr = cls(function, args, kwargs)
+    if cls is not tp:
+        expr._type = tp
+    return expr
+
+
 def wrapper(fn, args, kwargs, return_type):
     expr_return_type = extract_expression_type(return_type)
-    # Clone expression when returning it, so if if we mutate child expression
-    # those one won't be mutated
-    return clone_expression(expr_return_type(fn, list(args), kwargs))
+    if _INTERNED is None or not _IMMUTABLE:
+        if _IMMUTABLE:
+            return _create_expression(
+                expr_return_type, fn, tuple(args), HashableMapping(kwargs)
+            )
+        # Clone expression when returning it, so if if we mutate child expression
+        # those one won't be mutated
+        return clone_expression(
+            _create_expression(expr_return_type, fn, list(args), kwargs)
+        )
+
+    key = (
+        expr_return_type,
+        fn,
+        tuple(map(_intern_key, args)),
+        tuple((k, _intern_key(v)) for k, v in kwargs.items()),
+    )
+    try:
+        return _INTERNED[key]
+    except KeyError:
+        pass
+    expr = _create_expression(
+        expr_return_type, fn, tuple(args), HashableMapping(kwargs)
+    )
+    _INTERNED[key] = expr
+    return expr
 
 
 def expression(fn: T_callable) -> T_callable:
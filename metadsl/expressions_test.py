@@ -1,11 +1,15 @@
 from __future__ import annotations
 
+import gc
+import pickle
 import typing
 
 import pytest
 import typing_inspect
 
+from . import expressions
 from .expressions import *
+from .normalized import ExpressionReference
 
 T = typing.TypeVar("T")
 
@@ -56,6 +60,24 @@ def test_expression_subclass_generic() -> None:
     assert instance_arg_fn(10).get_inner_type() == int
 
 
+def test_type() -> None:
+    assert subclass_fn(1)._type is Subclass
+    assert instance_arg_fn(10)._type == Generic[int]
+    assert typing.cast(Expression, fn(1, 2))._type == PlaceholderExpression[int]
+    # The type is kept when creating new expressions from this one
+    assert instance_arg_fn(10)._with_children([11], {})._type == Generic[int]
+    assert (
+        typing.cast(Expression, clone_expression(fn(1, 2)))._type
+        == PlaceholderExpression[int]
+    )
+
+    # Also when creating it from the alias, like `typing` does
+    expr = Generic[int](instance_arg_fn, [10], {})
+    assert expr._type == Generic[int]
+    assert typing_inspect.get_generic_type(expr) == Generic[int]
+    assert typing_inspect.get_generic_type(subclass_fn(1)) == Subclass
+
+
 @expression
 def mutable_fn(a: typing.List) -> Expression:
     ...
@@ -72,6 +94,20 @@ def test_classmethod():
     assert isinstance(c.get(), Subclass)
 
 
+def test_pickle():
+    for expr in [
+        fn(1, 2),
+        Generic[Subclass].create().get(),
+        create_method_subclass(1) + create_method_subclass(2),
+    ]:
+        unpickled = pickle.loads(pickle.dumps(expr))
+        assert unpickled == expr
+        assert unpickled.function == expr.function
+        assert typing_inspect.get_generic_type(unpickled) == (
+            typing_inspect.get_generic_type(expr)
+        )
+
+
 @expression
 def create_method_subclass(i: int) -> SubclassWithMethod:
     ...
@@ -134,6 +170,68 @@ def test_clone_expression(instance) -> None:
     assert clone_expression(instance) == instance
 
 
+def test_clone_expression_shared() -> None:
+    x = value_fn(10)
+    expr = fn(x, x)
+    cloned = clone_expression(expr)
+    assert cloned == expr
+    assert cloned.args[0] is cloned.args[1]
+    assert cloned.args[0] is not x
+
+
+def test_clone_expression_dag() -> None:
+    """
+    Cloning a deep DAG with shared nodes should not unfold it into a tree
+    """
+    expr = value_fn(0)
+    for _ in range(100):
+        expr = fn(expr, expr)
+    cloned = clone_expression(expr)
+    for _ in range(100):
+        assert cloned.args[0] is cloned.args[1]
+        cloned = typing.cast(Expression, cloned.args[0])
+
+
+def deep_expression(depth: int) -> Expression:
+    toggle_immutable_expressions(True)
+    try:
+        expr = value_fn(0)
+        for _ in range(depth):
+            expr = fn(expr, expr)
+    finally:
+        toggle_immutable_expressions(False)
+    return clone_expression(expr)
+
+
+def test_deep_expression() -> None:
+    """
+    Traversing expressions deeper than the recursion limit should not recurse
+    """
+    expr = deep_expression(5000)
+    assert expr == deep_expression(5000)
+    assert expr != fn(deep_expression(4999), value_fn(0))
+    assert expr._structural_hash() == deep_expression(5000)._structural_hash()
+    assert clone_expression(expr) == expr
+
+
+def test_map_expression() -> None:
+    expr = fn(value_fn(1), value_fn(2))
+    assert map_expression(
+        expr, lambda e, args, kwargs: e._with_children(args, kwargs)
+    ) == fn(value_fn(1), value_fn(2))
+    assert map_expression(
+        expr,
+        lambda e, args, kwargs: e._with_children(args, kwargs),
+        lambda v: value_fn(3) if v == value_fn(2) else NotImplemented,
+    ) == fn(value_fn(1), value_fn(3))
+    # Leaves are kept unless they are shortcut
+    assert map_expression(
+        expr,
+        lambda e, args, kwargs: e._with_children(args, kwargs),
+        lambda v: 10 if v == 1 else NotImplemented,
+    ) == fn(value_fn(10), value_fn(2))
+
+
 U = typing.TypeVar("U")
 
 
@@ -159,3 +257,95 @@ def test_wrap_method() -> None:
     assert A.create() == A(A.create, [], {})
     assert A.create().method() == A(A.method, [A(A.create, [], {})], {})
     assert A.create().prop == A(A.prop, [A(A.create, [], {})], {})
+
+
+def test_interning():
+    toggle_interning(True)
+    toggle_immutable_expressions(True)
+    try:
+        assert value_fn(10) is value_fn(10)
+        assert value_fn(10) is not value_fn(11)
+        expr = fn(value_fn(10), value_fn(10))
+        assert expr.args[0] is expr.args[1]
+        assert expr is fn(value_fn(10), value_fn(10))
+        # Unhashable values are only shared if they are the same object
+        l = [1, 2, 3]
+        assert mutable_fn(l) is mutable_fn(l)
+        assert mutable_fn(l) is not mutable_fn([1, 2, 3])
+        assert Generic[int].create() is not Generic[str].create()
+    finally:
+        toggle_interning(False)
+        toggle_immutable_expressions(False)
+    assert value_fn(10) is not value_fn(10)
+
+
+def test_interning_mutable():
+    """
+    Mutable expressions are not interned, since replacing a child of one mutates it in place
+    """
+    toggle_interning(True)
+    try:
+        keep = fn(value_fn(10), value_fn(10))
+        expr = fn(value_fn(10), value_fn(10))
+        assert expr is not keep
+        ref = ExpressionReference.from_expression(expr)
+        (child,) = [r for r in ref.descendents if r.expression == value_fn(10)]
+        child.replace(value_fn(11))
+        assert ref.expression == fn(value_fn(11), value_fn(11))
+        assert keep == fn(value_fn(10), value_fn(10))
+    finally:
+        toggle_interning(False)
+
+
+def test_immutable_expressions():
+    toggle_immutable_expressions(True)
+    try:
+        child = value_fn(10)
+        expr = fn(child, child)
+        assert expr.args == (child, child)
+        # Children are shared instead of cloned
+        assert expr.args[0] is child
+        assert expr == fn(value_fn(10), value_fn(10))
+        # Cloning only copies mutable expressions
+        assert clone_expression(expr) is expr
+    finally:
+        toggle_immutable_expressions(False)
+    mutable = fn(value_fn(10), value_fn(10))
+    assert isinstance(mutable.args, list)
+    assert mutable == expr
+    assert clone_expression(mutable) is not mutable
+
+
+def test_interning_weak():
+    toggle_interning(True)
+    toggle_immutable_expressions(True)
+    try:
+        expr = value_fn(10)
+        assert len(expressions._INTERNED) == 1  # type: ignore
+        del expr
+        gc.collect()
+        assert len(expressions._INTERNED) == 0  # type: ignore
+    finally:
+        toggle_interning(False)
+        toggle_immutable_expressions(False)
+
+
+def test_structural_hash():
+    assert (
+        fn(value_fn(10), value_fn(11))._structural_hash()
+        == fn(value_fn(10), value_fn(11))._structural_hash()
+    )
+    assert fn(value_fn(10), value_fn(11)) != fn(value_fn(10), value_fn(12))
+    # Equal values of different types should still be equal
+    assert fn(1, 2) == fn(1.0, 2.0)
+    # Unhashable values are compared by equality
+    assert mutable_fn([1, 2, 3]) == mutable_fn([1, 2, 3])
+    assert mutable_fn([1, 2, 3]) != mutable_fn([1, 2])
+
+
+def test_structural_hash_reset():
+    expr = fn(value_fn(10), value_fn(11))
+    expr._structural_hash()
+    expr.args[1] = value_fn(10)
+    expr._hash = None
+    assert expr == fn(value_fn(10), value_fn(10))
@@ -3,83 +3,394 @@ Normalized expressions, for deduping and single replacements.
 """
 from __future__ import annotations
 
+import array
 import ast
 import collections
 import dataclasses
 import functools
+import hashlib
+import inspect
 import itertools
+import types
 import typing
 
-import black
-import igraph
 import typing_inspect
 
 from .expressions import *
-from .typing_tools import BoundInfer, get_type
+from .typing_tools import BoundInfer, Infer
 
 __all__ = [
     "ExpressionReference",
     "Children",
     "Hash",
     "hash_value",
+    "expression_digest",
+    "toggle_digest_hashes",
 ]
 
 Hash = typing.NewType("Hash", str)
 
 
-class Graph(igraph.Graph):
+Index = typing.Union[int, str]
+
+
+class Graph:
     """
-    Graph of all expression
+    Graph of all expressions, where every distinct expression is one node.
+
+    Nodes are stored in parallel arrays, indexed by their node id:
+    * `_expressions`: the expression object
+    * `_hashes`: the hash of the expression, or None while it is being recomputed
+    * `_orders`: increasing number recording when the node was added, used to order nodes
+    * `_row_starts`: where the children of the node start in `_children`
+    * `_n_args`: number of positional children of the node
+    * `_kwarg_keys`: keys of the keyword children of the node
+    * `_generations`: the generation in which the node was added or last changed
 
+    The children of all nodes are stored in one array, `_children`, as compressed rows. Each row
+    holds the node ids of the args and then of the kwargs of one node. Since the number of
+    children of a node never changes, rows are overwritten in place when children are
+    replaced. The rows of deleted nodes are left behind and compacted once they take up
+    more than half of the array.
 
+    Node ids are stable. A node is deleted as soon as its last parent drops it, which is
+    tracked by the parents of each node, and its id is put on a free list and reused for new
+    nodes.
 
-    Vertex attributes:
-    * `name`: string of hash of expression or None if not computed yet
-    * `expression`: expression object
+    Besides the arrays, the graph keeps the parents of each node, a mapping of hashes to
+    node ids, and the id of the root node, so that none of them have to be searched for.
 
-    Edge Attributes:
-    * `index`: int or string
+    Every replacement also records the hashes of the replaced node and of its ancestors, forwarded
+    to the hashes they were replaced with, so that an equal node that shows up later can be
+    replaced with the latest form of the earlier one, instead of being rewritten again.
+
+    Every replacement starts a new generation. Nodes that were added or that changed in it
+    are stamped with it, so that strategies can tell which nodes changed since they last
+    looked at them.
+    Nodes are also indexed by the id of their expression, so that adding an expression the
+    graph already holds doesn't walk it again.
     """
 
+    _expressions: typing.List[object]
+    _hashes: typing.List[typing.Optional[Hash]]
+    _orders: array.array
+    _row_starts: array.array
+    _n_args: array.array
+    _kwarg_keys: typing.List[typing.Tuple[str, ...]]
+    _generations: array.array
+    _children: array.array
+    # Number of times each parent has the node as a child
+    _parents: typing.List[typing.Counter[int]]
+    _free: typing.List[int]
+    _n_garbage: int
+    _next_order: int
+    _hash_to_index: typing.Dict[Hash, int]
+    _id_to_index: typing.Dict[int, int]
+    _root_index: int
+    # Increases with every replacement, and is not reset when the graph is cleared
+    _generation: int
+    # Nodes added or changed in the current generation
+    _affected: typing.List[int]
+    # Nodes added or changed in the last replacement that still exist, children before parents
+    _last_affected: typing.List[int]
+    # Mapping of the hashes of replaced nodes to the hashes and expressions they were replaced with.
+    # Like the generation, it is not reset when the graph is cleared.
+    _forwards: typing.Dict[Hash, typing.Tuple[Hash, object]]
+
     def __init__(self, expr: object = None):
-        super().__init__(directed=True)
+        self._generation = 0
+        self._last_affected = []
+        self._forwards = {}
+        self._clear()
         if expr is not None:
-            self._fully_add_expression(expr, None)
+            self._root_index = self._lookup_index(self._fully_add_expression(expr))
+            self._affected = []
             self._assert_integrity()
 
+    def _clear(self) -> None:
+        self._expressions = []
+        self._hashes = []
+        self._orders = array.array("q")
+        self._row_starts = array.array("q")
+        self._n_args = array.array("i")
+        self._kwarg_keys = []
+        self._generations = array.array("q")
+        self._children = array.array("i")
+        self._parents = []
+        self._free = []
+        self._n_garbage = 0
+        self._next_order = 0
+        self._hash_to_index = {}
+        self._id_to_index = {}
+        self._affected = []
+
+    def __len__(self) -> int:
+        """
+        Returns the number of nodes in the graph.
+        """
+        return len(self._expressions) - len(self._free)
+
     def _repr_svg_(self):
         return self.plot_custom()._repr_svg_()
 
+    def to_igraph(self):
+        """
+        Returns an igraph graph with the same nodes and edges, for plotting.
+
+        The vertices have `name` and `expression` attributes and the edges an `index` attribute.
+        """
+        import igraph
+
+        nodes = self._nodes()
+        vertex_ids = {node: i for i, node in enumerate(nodes)}
+        edges = [
+            (vertex_ids[node], vertex_ids[child], index)
+            for node in nodes
+            for index, child in self._edges(node)
+        ]
+        graph = igraph.Graph(directed=True)
+        graph.add_vertices(
+            len(nodes),
+            attributes={
+                "name": [self._hashes[node] for node in nodes],
+                "expression": [self._expressions[node] for node in nodes],
+            },
+        )
+        graph.add_edges(
+            [(source, target) for source, target, _ in edges],
+            attributes={"index": [index for _, _, index in edges]},
+        )
+        return graph
+
     def plot_custom(self):
+        import igraph
+
+        graph = self.to_igraph()
         return igraph.plot(
-            self,
-            layout=self.layout_sugiyama(),
+            graph,
+            layout=graph.layout_sugiyama(),
             vertex_label=[
                 f'{v.index}: {v["expression"].function if isinstance(v["expression"], Expression) else v["expression"]}'
-                for v in self.vs
+                for v in graph.vs
             ],
-            edge_label=self.es["index"],
+            edge_label=graph.es["index"],
             # vertex_shape="hidden",
         )
 
-    def _fully_add_expression(
+    def _nodes(self) -> typing.List[int]:
+        """
+        Returns the ids of all nodes, in the order they were added.
+        """
+        return sorted(
+            (node for node, order in enumerate(self._orders) if order >= 0),
+            key=self._orders.__getitem__,
+        )
+
+    def _row(self, node: int) -> typing.Tuple[int, int]:
+        """
+        Returns the start and end of the row of children of the node.
+        """
+        start = self._row_starts[node]
+        return start, start + self._n_args[node] + len(self._kwarg_keys[node])
+
+    def _child_nodes(self, node: int) -> typing.List[int]:
+        return self._children[slice(*self._row(node))].tolist()
+
+    def _child_index(self, node: int, position: int) -> Index:
+        """
+        Returns the arg index or kwarg key of the child at `position` in the row of the node.
+        """
+        n_args = self._n_args[node]
+        if position < n_args:
+            return position
+        return self._kwarg_keys[node][position - n_args]
+
+    def _edges(self, node: int) -> typing.List[typing.Tuple[Index, int]]:
+        """
+        Returns the arg index or kwarg key and the child node, for each child of the node.
+        """
+        n_args = self._n_args[node]
+        return list(
+            zip(
+                itertools.chain(range(n_args), self._kwarg_keys[node]),
+                self._child_nodes(node),
+            )
+        )
+
+    def _fully_add_expression(self, expr: object) -> Hash:
+        """
+        Adds the expression and all of its descendents that are not already in the graph,
+        bottom up with an explicit stack, and returns its hash.
+        """
+        hashes: typing.Dict[int, Hash] = {}
+        # Ids of the expressions whose children are being added
+        in_progress: typing.Set[int] = set()
+        stack: typing.List[typing.Tuple[object, bool]] = [(expr, False)]
+        while stack:
+            value, children_done = stack.pop()
+            key = id(value)
+            if not children_done:
+                if key in hashes:
+                    continue
+                if key in self._id_to_index:
+                    hashes[key] = typing.cast(
+                        Hash, self._hashes[self._id_to_index[key]]
+                    )
+                    continue
+                # should never be a child of one of its parents, or else we have a cycle
+                assert key not in in_progress
+                in_progress.add(key)
+                stack.append((value, True))
+                stack.extend((child, False) for _, child in expression_children(value))
+                continue
+
+            in_progress.remove(key)
+            edges = [
+                (index, hashes[id(child)])
+                for index, child in expression_children(value)
+            ]
+            hash_ = hashes[key] = self._hash(value, frozenset(edges))
+            if hash_ in self._hash_to_index:
+                continue
+            if not isinstance(value, Expression):
+                self._add_vertex(value, hash_)
+                continue
+            children = [self._hash_to_index[child_hash] for _, child_hash in edges]
+            self._add_vertex(
+                value, hash_, children, len(value.args), tuple(value.kwargs.keys())
+            )
+            # Frozen expressions keep their own children, which are equal to the nodes'
+            if not value._frozen:
+                for (index, _), child in zip(edges, children):
+                    if isinstance(index, int):
+                        value.args[index] = self._expressions[child]  # type: ignore
+                    else:
+                        value.kwargs[index] = self._expressions[child]  # type: ignore
+        return hashes[id(expr)]
+
+    def _add_vertex(
         self,
         expr: object,
-        replace: typing.Optional[typing.Tuple[Hash, object]],
-        *parent_ids: int,
+        hash_: Hash,
+        children: typing.Sequence[int] = (),
+        n_args: int = 0,
+        kwarg_keys: typing.Tuple[str, ...] = (),
+    ) -> int:
+        """
+        Adds a node with these children and returns its id.
+        """
+        if self._free:
+            node = self._free.pop()
+            self._expressions[node] = expr
+            self._hashes[node] = hash_
+            self._orders[node] = self._next_order
+            self._row_starts[node] = len(self._children)
+            self._n_args[node] = n_args
+            self._kwarg_keys[node] = kwarg_keys
+            self._generations[node] = self._generation
+        else:
+            node = len(self._expressions)
+            self._expressions.append(expr)
+            self._hashes.append(hash_)
+            self._orders.append(self._next_order)
+            self._row_starts.append(len(self._children))
+            self._n_args.append(n_args)
+            self._kwarg_keys.append(kwarg_keys)
+            self._generations.append(self._generation)
+            self._parents.append(collections.Counter())
+        self._next_order += 1
+        self._children.extend(children)
+        for child in children:
+            self._parents[child][node] += 1
+        self._hash_to_index[hash_] = node
+        self._id_to_index[id(expr)] = node
+        self._affected.append(node)
+        return node
+
+    def _set_hash(self, index: int, hash_: typing.Optional[Hash]) -> None:
+        """
+        Sets the hash of a node, or removes it if it is None.
+
+        A node without a hash is also removed from the id index, so that its expression
+        is not reused while it is changing.
+        """
+        prev_hash = self._hashes[index]
+        if prev_hash is not None:
+            del self._hash_to_index[prev_hash]
+            del self._id_to_index[id(self._expressions[index])]
+        if hash_ is not None:
+            self._hash_to_index[hash_] = index
+            self._id_to_index[id(self._expressions[index])] = index
+            self._generations[index] = self._generation
+            self._affected.append(index)
+        self._hashes[index] = hash_
+
+    def _release(self, nodes: typing.Iterable[int]) -> None:
+        """
+        Deletes the nodes that have lost all of their parents, and then any of their children
+        that have lost all of theirs, so that nodes are freed as soon as nothing refers to them.
+        """
+        stack = list(nodes)
+        while stack:
+            node = stack.pop()
+            if (
+                node == self._root_index
+                or self._parents[node]
+                or self._orders[node] < 0
+            ):
+                continue
+            stack.extend(self._child_nodes(node))
+            self._delete_vertex(node)
+        if self._n_garbage > len(self._children) // 2:
+            self._compact()
+
+    def _delete_vertex(self, node: int) -> None:
+        """
+        Deletes a node, putting its id on the free list.
+        """
+        self._set_hash(node, None)
+        start, end = self._row(node)
+        for child in self._children[start:end]:
+            self._remove_parent(child, node)
+        self._n_garbage += end - start
+        self._expressions[node] = None
+        self._orders[node] = -1
+        self._n_args[node] = 0
+        self._kwarg_keys[node] = ()
+        self._free.append(node)
+
+    def _remove_parent(self, node: int, parent: int) -> None:
+        """
+        Removes one of the times that the parent has the node as a child.
+        """
+        parents = self._parents[node]
+        parents[parent] -= 1
+        if not parents[parent]:
+            del parents[parent]
+
+    def _compact(self) -> None:
+        """
+        Removes the rows of deleted nodes from the children array.
+        """
+        children = array.array("i")
+        for node in self._nodes():
+            start, end = self._row(node)
+            self._row_starts[node] = len(children)
+            children.extend(self._children[start:end])
+        self._children = children
+        self._n_garbage = 0
+
+    @staticmethod
+    def _hash(
+        expr: object,
+        children: typing.FrozenSet[typing.Tuple[Index, Hash]],
     ) -> Hash:
-        # should never be a child of one of its parents, or else we have a cycle
-        assert id(expr) not in parent_ids
-        children = frozenset(
-            (
-                index,
-                self._fully_add_expression(
-                    child_expression, replace, id(expr), *parent_ids
-                ),
-            )
-            for index, child_expression in expression_children(expr)
-        )
-        hash_ = Hash(
+        """
+        Returns the hash of an expression, given the hashes of its children.
+        """
+        if _DIGEST_HASHES:
+            return _digest_hash(expr, children)
+        return Hash(
             str(
                 hash(
                     (
@@ -91,76 +402,290 @@ class Graph(igraph.Graph):
                 )
             )
         )
-        # If we are replacing a hash with a new expression and this is the hash of current expression, use the new one instead
-        # This means we have added a bunch of nodes we dont need possibly, so we can delete those at the end
-        if replace and hash_ == replace[0]:
-            return self._fully_add_expression(replace[1], None, *parent_ids)
+
+    def _lookup_index(self, hash_: Hash) -> int:
         try:
-            self._lookup(hash_)
-        except ValueError:
-            v = self.add_vertex(expression=expr, name=hash_)
+            return self._hash_to_index[hash_]
+        except KeyError:
+            raise ValueError(f"No vertex with hash {hash_}")
 
-            for index, child_hash in children:
-                assert isinstance(expr, Expression)
-                child_v = self._lookup(child_hash)
-                self.add_edge(v, child_v, index=index)
-                if isinstance(index, int):
-                    expr.args[index] = child_v["expression"]
-                else:
-                    expr.kwargs[index] = child_v["expression"]
-        return Hash(hash_)
+    def _lookup(self, hash_: Hash) -> object:
+        """
+        Returns the expression with this hash.
+        """
+        return self._expressions[self._lookup_index(hash_)]
 
-    def _lookup(self, hash_: Hash) -> igraph.Vertex:
-        return self.vs.find(name=hash_)
+    def _ancestors(self, index: int) -> typing.Set[int]:
+        """
+        Returns all nodes that have this node as a descendent.
+        """
+        ancestors: typing.Set[int] = set()
+        stack = [index]
+        while stack:
+            for parent in self._parents[stack.pop()]:
+                if parent not in ancestors:
+                    ancestors.add(parent)
+                    stack.append(parent)
+        return ancestors
+
+    def _reachable(self, index: int) -> typing.List[int]:
+        """
+        Returns the node and all of its descendents, breadth first.
+        """
+        seen = {index}
+        nodes = [index]
+        for node in nodes:
+            for child in self._child_nodes(node):
+                if child not in seen:
+                    seen.add(child)
+                    nodes.append(child)
+        return nodes
+
+    def _topological_order(self) -> typing.List[int]:
+        """
+        Returns all nodes, each after all of its children, so with the root last.
+
+        Nodes are released in a queue, starting from the leaves in the order they were added,
+        and then the parents of each node in the order they were added, so that the order is
+        deterministic and matches `igraph.Graph.topological_sorting(mode="in")`.
+        """
+        orders = self._orders
+        n_waiting = {
+            node: self._row(node)[1] - self._row(node)[0] for node in self._nodes()
+        }
+        queue = collections.deque(node for node, n in n_waiting.items() if n == 0)
+        result = []
+        while queue:
+            node = queue.popleft()
+            result.append(node)
+            for parent in sorted(self._parents[node], key=orders.__getitem__):
+                n_waiting[parent] -= self._parents[node][parent]
+                if n_waiting[parent] == 0:
+                    queue.append(parent)
+        return result
+
+    def _is_changed(self, node: int, generation: int) -> bool:
+        """
+        Returns whether the node was added or changed after `generation`, or was deleted.
+        """
+        return self._orders[node] < 0 or self._generations[node] > generation
 
-    def replace_root(self, expr: object):
-        self.delete_vertices(self.vs)
-        self._fully_add_expression(expr, None)
+    def _finish_replacement(self) -> typing.List[int]:
+        """
+        Returns the nodes that were added or changed in this replacement and still exist,
+        children before parents.
+        """
+        affected = [
+            node for node in dict.fromkeys(self._affected) if self._orders[node] >= 0
+        ]
+        self._affected = []
+        self._last_affected = affected
+        return affected
+
+    def _forward(self, prev_hash: Hash, node: int) -> None:
+        """
+        Records that the node with `prev_hash` was replaced by `node`.
+        """
+        hash_ = typing.cast(Hash, self._hashes[node])
+        if hash_ != prev_hash:
+            self._forwards[prev_hash] = (hash_, self._expressions[node])
+
+    def _latest_form(self, node: int) -> typing.Optional[object]:
+        """
+        Returns the latest expression that a node with the same hash as this one was replaced
+        with, or None if there isn't one.
+
+        If that expression is still in the graph, its current expression is returned. Otherwise
+        the expression as it was when it was replaced.
+        """
+        hash_ = typing.cast(Hash, self._hashes[node])
+        seen = {hash_}
+        expr = None
+        while hash_ in self._forwards:
+            hash_, expr = self._forwards[hash_]
+            if hash_ in seen:
+                # The replacements form a cycle, so there is no latest form
+                return None
+            seen.add(hash_)
+        if expr is None:
+            return None
+        target = self._hash_to_index.get(hash_, self._id_to_index.get(id(expr)))
+        if target is None:
+            return expr
+        # Don't replace a node with one of its ancestors, which would create a cycle
+        if target == node or target in self._ancestors(node):
+            return None
+        return self._expressions[target]
+
+    def replace_root(self, expr: object) -> typing.List[int]:
+        """
+        Replaces the whole graph with a new expression, and returns all of its nodes.
+        """
+        self._generation += 1
+        prev_hash = self._hashes[self._root_index] if self._expressions else None
+        self._clear()
+        self._root_index = self._lookup_index(self._fully_add_expression(expr))
+        if prev_hash is not None:
+            self._forward(prev_hash, self._root_index)
         self._assert_integrity()
+        return self._finish_replacement()
+
+    def replace_child(self, expr: object, prev_index: int) -> typing.List[int]:
+        """
+        Replaces the node at `prev_index` with a new expression.
+
+        Only the ancestors of the replaced node can change their hashes, so those are
+        recomputed bottom up, each after all of its changed children, and their rows are
+        rewritten to point to the new children. If an ancestor ends up with the same hash as
+        an existing node, it is merged into that one.
+
+        Returns the nodes that were added or changed, which are the only ones whose
+        descendents are different than before. All other nodes keep their ids.
+        """
+        self._generation += 1
+        root_index = self._root_index
+        ancestors = self._ancestors(prev_index)
+        prev_hashes = {node: self._hashes[node] for node in (prev_index, *ancestors)}
+
+        # Clear the stale hashes of the ancestors before adding the new expression, so that
+        # nothing in it is deduplicated against a node that is about to change
+        for ancestor in ancestors:
+            self._set_hash(ancestor, None)
+            expr_ = self._expressions[ancestor]
+            # Also reset the cached structural hash, since one of its descendents will change.
+            # Frozen expressions are rebuilt instead, so theirs stays valid.
+            if not expr_._frozen:  # type: ignore
+                expr_._hash = None  # type: ignore
+        new_index = self._lookup_index(self._fully_add_expression(expr))
+
+        # Mapping of nodes that were replaced to the nodes that replaced them
+        replaced = {prev_index: new_index}
+        # Nodes that lost a parent, which are deleted if it was their last one
+        released = []
+        changed = {prev_index, *ancestors}
+        # Number of changed children each ancestor is waiting on before it can be rehashed
+        n_waiting = {
+            ancestor: len(changed.intersection(self._child_nodes(ancestor)))
+            for ancestor in ancestors
+        }
+
+        ready = [prev_index]
+        while ready:
+            for ancestor in ancestors.intersection(self._parents[ready.pop()]):
+                n_waiting[ancestor] -= 1
+                if n_waiting[ancestor]:
+                    continue
+                ready.append(ancestor)
+
+                start, end = self._row(ancestor)
+                prev_targets = self._children[start:end]
+                targets = [replaced.get(target, target) for target in prev_targets]
+                indices = [
+                    self._child_index(ancestor, position)
+                    for position in range(end - start)
+                ]
+                hash_ = self._hash(
+                    self._expressions[ancestor],
+                    frozenset(
+                        (index, self._hashes[target])  # type: ignore
+                        for index, target in zip(indices, targets)
+                    ),
+                )
+                if hash_ in self._hash_to_index:
+                    replaced[ancestor] = self._hash_to_index[hash_]
+                    continue
+                self._set_hash(ancestor, hash_)
+                for position, (prev_target, target) in enumerate(
+                    zip(prev_targets, targets)
+                ):
+                    if target == prev_target:
+                        continue
+                    self._children[start + position] = target
+                    self._remove_parent(prev_target, ancestor)
+                    self._parents[target][ancestor] += 1
+                    released.append(prev_target)
+                self._update_children(
+                    ancestor,
+                    {
+                        index: self._expressions[target]
+                        for index, target in zip(indices, targets)
+                    },
+                )
+
+        for node, prev_hash in prev_hashes.items():
+            self._forward(typing.cast(Hash, prev_hash), replaced.get(node, node))
+        self._root_index = replaced.get(root_index, root_index)
+        released.append(root_index)
+        self._release(released)
+        return self._finish_replacement()
 
-    def replace_child(self, expr: object, prev_index: int) -> None:
-        # Compute previous hash on the fly instead of passing it in b/c even though previous index
-        # must stay constant, the previous hash could have changed between we created this sub-graph
-        # and after the rule when we are replacing the expression
-        root_expression = self.root_vertex["expression"]
-
-        prev_expr = self.vs[prev_index]["expression"]
-        # clear graph
-        self.delete_vertices(self.vs)
-        prev_hash = self._fully_add_expression(prev_expr, None)
-
-        self.delete_vertices(self.vs)
-        new_hash = self._fully_add_expression(root_expression, (prev_hash, expr))
-        # Remove all vertice not children of new root node
-        self.delete_vertices(
-            set(self.vs.indices) - set(self.subcomponent(new_hash, igraph.OUT))
+    def _update_children(
+        self, index: int, children: typing.Dict[Index, object]
+    ) -> None:
+        """
+        Points the args and kwargs of the expression at `index` to the new children.
+
+        Mutable expressions are updated in place. Frozen ones are copied, and the copy
+        replaces them in the graph.
+        """
+        expr = typing.cast(Expression, self._expressions[index])
+        changed = {
+            i: child
+            for i, child in children.items()
+            if (expr.args[i] if isinstance(i, int) else expr.kwargs[i]) is not child
+        }
+        if not changed:
+            return
+        if not expr._frozen:
+            for i, child in changed.items():
+                if isinstance(i, int):
+                    expr.args[i] = child  # type: ignore
+                else:
+                    expr.kwargs[i] = child  # type: ignore
+            return
+        new_expr = expr._with_children(
+            (changed.get(i, arg) for i, arg in enumerate(expr.args)),
+            {k: changed.get(k, v) for k, v in expr.kwargs.items()},
         )
-        self._assert_integrity()
+        if self._id_to_index.get(id(expr)) == index:
+            del self._id_to_index[id(expr)]
+            self._id_to_index[id(new_expr)] = index
+        self._expressions[index] = new_expr
 
     def _assert_integrity(self):
-        assert self.is_dag()
-        # Verify that this is one connected graph (not multiple roots)
-        assert self.is_connected(igraph.WEAK)
+        nodes = self._nodes()
+        # Verify that this is acyclic, and one connected graph (not multiple roots)
+        assert sorted(self._topological_order()) == sorted(nodes)
+        assert sorted(self._reachable(self._root_index)) == sorted(nodes)
+        assert not self._parents[self._root_index]
 
         # Assert hashes and ids are unique
-        hashes = self.vs["name"]
-        assert len(hashes) == len(set(hashes))
-        # assert edges are unique, with respect to source
-        edges = [(e.source, e["index"]) for e in self.es]
-        assert len(edges) == len(set(edges))
-
-        for v in self.vs:
-            expr = v["expression"]
-            for e in v.out_edges():
-                idx = e["index"]
+        assert self._hash_to_index == {self._hashes[node]: node for node in nodes}
+        assert len(self._hash_to_index) == len(nodes)
+        assert self._id_to_index == {
+            id(self._expressions[node]): node for node in nodes
+        }
+
+        # Assert parents match the children
+        parents: typing.Dict[int, typing.Counter[int]] = {
+            node: collections.Counter() for node in nodes
+        }
+        for node in nodes:
+            for child in self._child_nodes(node):
+                parents[child][node] += 1
+        assert all(self._parents[node] == parents[node] for node in nodes)
+
+        for node in nodes:
+            expr = self._expressions[node]
+            for idx, child in self._edges(node):
+                assert isinstance(expr, Expression)
                 child_expr = (
                     expr.args[idx] if isinstance(idx, int) else expr.kwargs[idx]
                 )
-                assert id(child_expr) == id(e.target_vertex["expression"])
-
-    @property
-    def root_vertex(self) -> igraph.Vertex:
-        return self.vs.select(_indegree_eq=0)[0]
+                if expr._frozen:
+                    assert child_expr == self._expressions[child]
+                else:
+                    assert id(child_expr) == id(self._expressions[child])
 
 
 @dataclasses.dataclass
@@ -187,63 +712,76 @@ class ExpressionReference:
     def _is_root(self):
         return self._optional_index is None
 
-    def replace(self, new_expression: object) -> None:
+    def replace(self, new_expression: object) -> typing.List[ExpressionReference]:
         """
-        Replace this expression with a new one
+        Replace this expression with a new one.
+
+        Returns references to the nodes that were added or changed by the replacement, children
+        before parents. Only these can match differently than before.
         """
 
         if self._is_root:
-            self._graph.replace_root(new_expression)
+            affected = self._graph.replace_root(new_expression)
         else:
-            self._graph.replace_child(
+            affected = self._graph.replace_child(
                 new_expression, typing.cast(int, self._optional_index)
             )
             # Reset index after replacing b/c we don't know index of newly replaced child
             # (we could, but not sure we need it since we only replace once then through this object anaway)
             self._optional_index = None
+        root_index = self._graph._root_index
+        return [
+            ExpressionReference(self._graph, None if i == root_index else i)
+            for i in affected
+        ]
 
     @property
     def _index(self) -> int:
-        return self._graph.root_vertex.index if self._is_root else self._optional_index
-
-    @property
-    def _vertex(self) -> igraph.Vertex:
-        return self._graph.vs[self._index]
+        return (
+            self._graph._root_index
+            if self._optional_index is None
+            else self._optional_index
+        )
 
     @property
     def hash(self) -> Hash:
         """
         Returns the Hash of the top level expression
         """
-        return Hash(self._vertex["name"])
+        return typing.cast(Hash, self._graph._hashes[self._index])
 
     @property
     def expression(self) -> object:
         """
         Returns the expression this references
         """
-        return self._vertex["expression"]
+        return self._graph._expressions[self._index]
 
     @property
     def children(self) -> Children:
         """
         Returns the direct children of this node if it has any.
         """
-        args = {}
+        graph = self._graph
+        args = []
         kwargs = {}
-        for e in self._graph.es[self._graph.incident(self.hash, igraph.OUT)]:
-            index = e["index"]
-            target_hash = e.target_vertex["name"]
+        for index, child in graph._edges(self._index):
+            child_hash = typing.cast(Hash, graph._hashes[child])
             if isinstance(index, int):
-                args[index] = target_hash
+                args.append(child_hash)
             else:
-                kwargs[index] = target_hash
-        return Children(
-            kwargs=kwargs,
-            args=tuple(
-                id_ for index, id_ in sorted(args.items(), key=lambda kv: kv[0])
-            ),
-        )
+                kwargs[index] = child_hash
+        return Children(kwargs=kwargs, args=tuple(args))
+
+    @property
+    def parents(self) -> typing.List[ExpressionReference]:
+        """
+        Returns the nodes that have this one as a child, once for each time it is a child.
+        """
+        return [
+            ExpressionReference(self._graph, i)
+            for i in self._graph._parents[self._index].elements()
+        ]
 
     @property
     def descendents(self) -> typing.Iterable[ExpressionReference]:
@@ -255,10 +793,10 @@ class ExpressionReference:
         """
         # If we are the root node return all topological with root nodes last
         if self._is_root:
-            indices = self._graph.topological_sorting(igraph.IN)
+            indices = self._graph._topological_order()
         # Otherwise return all subcomponents
         else:
-            indices = self._graph.subcomponent(self._optional_index, igraph.OUT)
+            indices = self._graph._reachable(typing.cast(int, self._optional_index))
         return [ExpressionReference(self._graph, i) for i in indices]
 
 
@@ -274,12 +812,14 @@ class Children:
 
 
 @functools.singledispatch
-def hash_value(value: object) -> int:
+def hash_value(value: object) -> typing.Union[int, bytes]:
     """
     Computes some hash for a value that should be stable. Either use the built in hash, or if we cannot
     (like the object is mutable) then use the id.
 
     It's a single dispatch function so that you can register custom hashes for objects you don't control.
+    Those that return bytes are also used to digest the objects, so they should only depend on
+    their contents, see `expression_digest`.
     """
     try:
         return hash((type(value), value))
@@ -287,6 +827,149 @@ def hash_value(value: object) -> int:
         return hash((type(value), id(value)))
 
 
+_DIGEST_HASHES = False
+
+
+def toggle_digest_hashes(enabled: bool) -> None:
+    """
+    Turns digest hashes for graphs on or off.
+
+    When it is on, the hashes of nodes are digests of their contents, like `expression_digest`,
+    instead of built in hashes. They don't change between processes or with `PYTHONHASHSEED`, so
+    they can be stored or compared across processes, but they take longer to compute.
+
+    Values that can't be identified by their contents still get a hash that only holds in this process.
+    To give a type a stable digest, register a `hash_value` for it that returns bytes.
+    """
+    global _DIGEST_HASHES
+    _DIGEST_HASHES = enabled
+
+
+def _digest_hash(
+    expr: object, children: typing.FrozenSet[typing.Tuple[Index, Hash]]
+) -> Hash:
+    """
+    Returns the digest of an expression, given the digests of its children, which is
+    the same as its `expression_digest` if it has one.
+    """
+    if not isinstance(expr, Expression):
+        return Hash(_digest_leaf(expr, unstable=True).hex())  # type: ignore
+    args = [
+        bytes.fromhex(hash_)
+        for _, hash_ in sorted(child for child in children if isinstance(child[0], int))
+    ]
+    kwargs = {
+        typing.cast(str, index): bytes.fromhex(hash_)
+        for index, hash_ in children
+        if isinstance(index, str)
+    }
+    return Hash(_digest_node(expr, args, kwargs, unstable=True).hex())
+
+
+def expression_digest(value: object) -> str:
+    """
+    Returns a digest of the contents of an expression, which is the same in every process,
+    unlike its hash.
+
+    Expressions are digested from their function and the digests of their children. Leaves
+    can be primitives, tuples of them, types, functions that can be imported by their
+    name, or values with a `hash_value` that returns bytes. For other values, which can't be
+    identified by their contents, a TypeError is raised.
+    """
+    return typing.cast(
+        bytes, map_expression(value, _digest_node, _digest_leaf)  # type: ignore
+    ).hex()
+
+
+def _digest_node(
+    expr: Expression,
+    args: typing.List[bytes],
+    kwargs: typing.Dict[str, bytes],
+    unstable: bool = False,
+) -> bytes:
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(_encode_leaf(expr.function, unstable))
+    digest.update(b"(%d)" % len(args))
+    for arg in args:
+        digest.update(arg)
+    for key in sorted(kwargs):
+        digest.update(key.encode() + b"=")
+        digest.update(kwargs[key])
+    return digest.digest()
+
+
+def _digest_leaf(value: object, unstable: bool = False) -> object:
+    if isinstance(value, Expression):
+        return NotImplemented
+    return hashlib.blake2b(_encode_leaf(value, unstable), digest_size=20).digest()
+
+
+_PRIMITIVES = (type(None), bool, int, float, complex, str, bytes)
+
+
+def _encode_leaf(value: object, unstable: bool = False) -> bytes:
+    """
+    Encodes a value that is not an expression as bytes that are the same in every process.
+
+    If `unstable` is true, values that can't be encoded like that are encoded with their
+    `hash_value` instead of raising a TypeError.
+    """
+    try:
+        return _encode_stable_leaf(value)
+    except TypeError:
+        if not unstable:
+            raise
+    return b"unstable:%s:%s" % (
+        _qualified_name(type(value), check=False),
+        repr(hash_value(value)).encode(),
+    )
+
+
+def _encode_stable_leaf(value: object) -> bytes:
+    if isinstance(value, Expression):
+        return b"expression:" + expression_digest(value).encode()
+    if type(value) in _PRIMITIVES:
+        return f"{type(value).__name__}:{value!r}".encode()
+    if isinstance(value, (tuple, frozenset)):
+        items: typing.Iterable[bytes] = map(_encode_leaf, value)
+        if isinstance(value, frozenset):
+            items = sorted(items)
+        return f"{type(value).__name__}(".encode() + b",".join(items) + b")"
+    if isinstance(value, BoundInfer):
+        return b"bound:%s.%s:%d" % (
+            _encode_leaf(value.owner),
+            value.fn.__name__.encode(),
+            value.is_classmethod,
+        )
+    if isinstance(value, Infer):
+        return b"infer:" + _qualified_name(inspect.unwrap(value.fn))
+    if isinstance(value, (type, types.FunctionType, types.BuiltinFunctionType)):
+        return b"object:" + _qualified_name(value)
+    if isinstance(value, typing.TypeVar) or typing_inspect.get_origin(value):  # type: ignore
+        name = repr(value)
+        if "<" in name:
+            raise TypeError(f"Cannot digest {value!r}, since it has no unique name")
+        return b"type:" + name.encode()
+    if hash_value.dispatch(type(value)) is not _default_hash_value:
+        encoded = hash_value(value)
+        if isinstance(encoded, bytes):
+            return b"%s:%s" % (_qualified_name(type(value)), encoded)
+    raise TypeError(f"Cannot digest {value!r} of type {type(value)}")
+
+
+_default_hash_value = hash_value.dispatch(object)
+
+
+def _qualified_name(value: object, check: bool = True) -> bytes:
+    name = (
+        f"{getattr(value, '__module__', None)}.{getattr(value, '__qualname__', None)}"
+    )
+    # Local functions and lambdas can't be told apart by their names
+    if check and "<" in name:
+        raise TypeError(f"Cannot digest {value!r}, since it has no unique name")
+    return name.encode()
+
+
 def expression_children(
     expr: object,
 ) -> typing.Iterable[typing.Tuple[typing.Union[int, str], object]]:
@@ -304,23 +987,24 @@ def graph_str(graph: Graph) -> str:
     If a leaf is a primitive (1, "dfd", None), don't create a temp variables for it.
     When printing the function, use the named primitive if it exists or just print it.
     """
-    indices = graph.topological_sorting(igraph.IN)
+    import black
+
+    indices = graph._topological_order()
     # Mapping from the string type name to the current index of the temp variable
     tp_name_to_index: typing.DefaultDict[str, int] = collections.defaultdict(lambda: 0)
     hash_to_str: dict[str, str] = {}
     lines = []
     for i in indices:
-        n = graph.vs[i]
-        hash_ = n["name"]
-        expr = n["expression"]
+        hash_ = typing.cast(Hash, graph._hashes[i])
+        expr = graph._expressions[i]
         if isinstance(expr, Expression):
             args = [
-                (f"{e['index']}=" if isinstance(e["index"], str) else "")
-                + hash_to_str[e.target_vertex["name"]]
+                (f"{index}=" if isinstance(index, str) else "")
+                + hash_to_str[graph._hashes[child]]  # type: ignore
                 # Sort edges with positional first, then keyword
-                for e in sorted(
-                    n.out_edges(),
-                    key=lambda e: (isinstance(e["index"], int), e["index"]),
+                for index, child in sorted(
+                    graph._edges(i),
+                    key=lambda e: (isinstance(e[0], int), e[0]),
                 )
             ]
             # If this is a method, record it like that
@@ -352,7 +1036,7 @@ def graph_str(graph: Graph) -> str:
             # Never save a primitive value as a temp variable
             no_temp_var = True
 
-        n_references = len(n.in_edges())
+        n_references = sum(graph._parents[i].values())
         if n_references == 0:
             # Last node
             lines.append(value_str)
@@ -362,7 +1046,7 @@ def graph_str(graph: Graph) -> str:
         else:
             # Multiple references, so save as tmp variable
             if isinstance(expr, PlaceholderExpression):
-                (tp,) = typing_inspect.get_args(get_type(expr))
+                (tp,) = typing_inspect.get_args(expr._type)
             else:
                 tp = type(expr)
             # Special case Any on Python < 3.10, it doesnt have a __name__
@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+import os
+import subprocess
+import sys
 import typing
 
 import pytest
@@ -101,6 +104,17 @@ def test_graph_subtree():
     assert ref.expression == orig
 
 
+def test_add_existing_expression(monkeypatch):
+    """
+    Adding an expression that is already in the graph should reuse its vertex, without rehashing it
+    """
+    graph = Graph(a(b(c())))
+    child = graph._expressions[graph._root_index].args[0]
+    monkeypatch.setattr(Graph, "_hash", None)
+    assert graph._lookup(graph._fully_add_expression(child)) is child
+    assert len(graph) == 3
+
+
 def test_doesnt_remember_replacements():
     ref = ExpressionReference.from_expression(a(b(c())))
     ref.replace(a(b(d())))
@@ -109,6 +123,180 @@ def test_doesnt_remember_replacements():
     assert ref.expression == a(b(c()))
 
 
+def test_replace_child_merges_ancestors():
+    """
+    Replacing a child so that two of its ancestors become equal should merge them
+    """
+    ref = ExpressionReference.from_expression(e(f(c()), f(d())))
+    (c_ref,) = [r for r in ref.descendents if r.expression == c()]
+    c_ref.replace(d())
+
+    assert ref.expression == e(f(d()), f(d()))
+    assert ref.expression._structural_hash() == e(f(d()), f(d()))._structural_hash()
+    ref._graph._assert_integrity()
+    assert len(ref._graph) == 3
+    assert ref.expression.args[0] is ref.expression.args[1]
+
+
+def test_replace_child_immutable():
+    """
+    Replacing a child of frozen expressions should rebuild its ancestors, instead of
+    mutating them
+    """
+    toggle_immutable_expressions(True)
+    try:
+        expr = e(f(c()), g(c()))
+        ref = ExpressionReference.from_expression(expr)
+        (c_ref,) = [r for r in ref.descendents if r.expression == c()]
+        c_ref.replace(d())
+    finally:
+        toggle_immutable_expressions(False)
+
+    assert ref.expression == e(f(d()), g(d()))
+    assert expr == e(f(c()), g(c()))
+    assert ref.expression.args[0].args[0] is ref.expression.args[1].args[0]
+    ref._graph._assert_integrity()
+
+
+def test_deep_expression():
+    """
+    Adding and replacing in expressions deeper than the recursion limit should not recurse
+    """
+    expr = c()
+    for _ in range(3000):
+        expr = Expression(b, [expr], {})
+    ref = ExpressionReference.from_expression(expr)
+    assert len(ref._graph) == 3001
+    (c_ref,) = [r for r in ref.descendents if r.expression == c()]
+    c_ref.replace(d())
+
+    expected = d()
+    for _ in range(3000):
+        expected = Expression(b, [expected], {})
+    assert ref.expression == expected
+
+
+def test_replace_child_stable_indices():
+    """
+    Replacing a child should not change the indices of the nodes that are kept
+    """
+    ref = ExpressionReference.from_expression(e(f(c()), g(d())))
+    (c_ref,) = [r for r in ref.descendents if r.expression == c()]
+    (g_ref,) = [r for r in ref.descendents if r.expression == g(d())]
+    c_ref.replace(b(c()))
+
+    assert g_ref.expression == g(d())
+    assert ref.expression == e(f(b(c())), g(d()))
+
+
+def test_replace_child_reuses_rows():
+    """
+    Replacing children many times should reuse deleted nodes and compact their rows
+    """
+    ref = ExpressionReference.from_expression(a(b(c())))
+    for i in range(50):
+        (child_ref,) = [r for r in ref.descendents if r.expression in (c(), d())]
+        child_ref.replace(d() if i % 2 == 0 else c())
+        ref._graph._assert_integrity()
+    assert ref.expression == a(b(c()))
+    assert len(ref._graph._expressions) <= 5
+    assert len(ref._graph._children) <= 4
+
+
+def test_replace_child_releases():
+    """
+    Replacing a child should delete it and any of its descendents that are no longer used
+    """
+    ref = ExpressionReference.from_expression(e(f(b(c())), b(d())))
+    (f_ref,) = [r for r in ref.descendents if r.expression == f(b(c()))]
+    f_ref.replace(d())
+
+    assert ref.expression == e(d(), b(d()))
+    ref._graph._assert_integrity()
+    assert len(ref._graph) == 3
+
+
+def test_replace_child_releases_shared():
+    """
+    Releasing a node that is a child many times should remove it from all of its parents
+    """
+    ref = ExpressionReference.from_expression(e(a(e(c(), c())), b(c())))
+    (c_ref,) = [r for r in ref.descendents if r.expression == c()]
+    assert [r.expression for r in c_ref.parents].count(e(c(), c())) == 2
+    assert len(c_ref.parents) == 3
+    (a_ref,) = [r for r in ref.descendents if r.expression == a(e(c(), c()))]
+    a_ref.replace(d())
+
+    assert ref.expression == e(d(), b(c()))
+    ref._graph._assert_integrity()
+    assert [r.expression for r in c_ref.parents] == [b(c())]
+
+
+def test_to_igraph():
+    pytest.importorskip("igraph")
+    graph = Graph(e(f(c()), g(c()))).to_igraph()
+    assert graph.vcount() == 4
+    assert sorted(graph.es["index"]) == [0, 0, 0, 1]
+    assert graph.vs[graph.topological_sorting(mode="in")[-1]]["expression"] == e(
+        f(c()), g(c())
+    )
+
+
+def test_replace_affected():
+    """
+    Replacing should return the nodes that were added or changed, children first
+    """
+    ref = ExpressionReference.from_expression(e(f(c()), g(d())))
+    (c_ref,) = [r for r in ref.descendents if r.expression == c()]
+    (d_ref,) = [r for r in ref.descendents if r.expression == d()]
+    assert [r.expression for r in d_ref.parents] == [g(d())]
+
+    affected = c_ref.replace(b(c()))
+    assert [r.expression for r in affected] == [
+        b(c()),
+        f(b(c())),
+        e(f(b(c())), g(d())),
+    ]
+    assert affected[-1]._is_root
+
+
+def test_replace_child_shared():
+    """
+    Replacing a child with multiple parents should replace it in all of them
+    """
+    ref = ExpressionReference.from_expression(e(f(c()), g(c())))
+    (c_ref,) = [r for r in ref.descendents if r.expression == c()]
+    c_ref.replace(d())
+
+    assert ref.expression == e(f(d()), g(d()))
+    ref._graph._assert_integrity()
+    assert len(ref._graph) == 4
+
+
+def test_replace_child_containing_itself():
+    """
+    The replacement can contain the node it replaces
+    """
+    ref = ExpressionReference.from_expression(a(b(c())))
+    (c_ref,) = [r for r in ref.descendents if r.expression == c()]
+    c_ref.replace(b(c()))
+
+    assert ref.expression == a(b(b(c())))
+    ref._graph._assert_integrity()
+
+
+def test_replace_child_with_existing_ancestor_hash():
+    """
+    An ancestor's new hash can be the same as another ancestor's previous hash
+    """
+    ref = ExpressionReference.from_expression(e(a(c()), a(b(c()))))
+    (c_ref,) = [r for r in ref.descendents if r.expression == c()]
+    c_ref.replace(b(c()))
+
+    assert ref.expression == e(a(b(c())), a(b(b(c()))))
+    ref._graph._assert_integrity()
+
+
 class E(Expression):
     @expression
     @classmethod
@@ -145,3 +333,111 @@ class E(Expression):
 )
 def test_graph_str(expr, s):
     assert graph_str(Graph(expr)) == s
+
+
+def test_latest_form():
+    """
+    A node equal to one that was replaced should be forwarded to the latest form it was replaced with
+    """
+    ref = ExpressionReference.from_expression(e(f(c()), g(d())))
+    graph = ref._graph
+    (c_ref,) = [r for r in ref.descendents if r.expression == c()]
+    c_ref.replace(b(d()))
+    (b_ref,) = [r for r in ref.descendents if r.expression == b(d())]
+    b_ref.replace(d())
+    assert ref.expression == e(f(d()), g(d()))
+
+    (g_ref,) = [r for r in ref.descendents if r.expression == g(d())]
+    g_ref.replace(a(c()))
+    (c_ref,) = [r for r in ref.descendents if r.expression == c()]
+    (a_ref,) = [r for r in ref.descendents if r.expression == a(c())]
+    assert graph._latest_form(c_ref._index) == d()
+    assert graph._latest_form(a_ref._index) is None
+
+    # The ancestors of the replaced nodes are forwarded as well, even after replacing the root
+    ref.replace(g(f(c())))
+    (f_ref,) = [r for r in ref.descendents if r.expression == f(c())]
+    assert graph._latest_form(f_ref._index) == f(d())
+    assert graph._latest_form(graph._root_index) is None
+
+
+def test_latest_form_ancestor():
+    """
+    A node should not be forwarded to one of its ancestors
+    """
+    ref = ExpressionReference.from_expression(b(c()))
+    (c_ref,) = [r for r in ref.descendents if r.expression == c()]
+    c_ref.replace(a(c()))
+    assert ref.expression == b(a(c()))
+    (c_ref,) = [r for r in ref.descendents if r.expression == c()]
+    assert ref._graph._latest_form(c_ref._index) is None
+
+
+def test_expression_digest():
+    assert expression_digest(e(f(c()), g(1))) == expression_digest(e(f(c()), g(1)))
+    assert expression_digest(e(f(c()), g(1))) != expression_digest(e(f(c()), g(2)))
+    assert expression_digest(e(f(c()), g(1))) != expression_digest(e(g(c()), f(1)))
+    assert expression_digest((1, "a")) != expression_digest(("1", "a"))
+    with pytest.raises(TypeError):
+        expression_digest(a(lambda: 1))
+    with pytest.raises(TypeError):
+        expression_digest(a(object()))
+
+
+def test_expression_digest_stable():
+    """
+    The digest should not depend on the hash seed of the process
+    """
+    code = "from metadsl.normalized_test import *; print(expression_digest(e(f(c()), g('a'))))"
+    digests = {
+        subprocess.run(
+            [sys.executable, "-c", code],
+            capture_output=True,
+            text=True,
+            check=True,
+            env={**os.environ, "PYTHONHASHSEED": seed},
+        ).stdout
+        for seed in ["1", "2"]
+    }
+    assert digests == {expression_digest(e(f(c()), g("a"))) + "\n"}
+
+
+class _Point:
+    def __init__(self, x: int):
+        self.x = x
+
+
+def _hash_point(value: _Point) -> bytes:
+    return str(value.x).encode()
+
+
+def test_digest_hashes():
+    expr = e(f(c()), g(a(e=1)))
+    default_hash_point = hash_value.dispatch(_Point)
+    hash_value.register(_Point, _hash_point)
+    toggle_digest_hashes(True)
+    try:
+        ref = ExpressionReference.from_expression(expr)
+        assert ref.hash == expression_digest(expr)
+        (c_ref,) = [r for r in ref.descendents if r.expression == c()]
+        c_ref.replace(d())
+        assert ref.hash == expression_digest(e(f(d()), g(a(e=1))))
+        ref._graph._assert_integrity()
+
+        # Values without a digest still get a hash
+        first, second = object(), object()
+        assert (
+            ExpressionReference.from_expression(a(first)).hash
+            != ExpressionReference.from_expression(a(second)).hash
+        )
+
+        # Registered hashes that return bytes are used in digests
+        assert expression_digest(a(_Point(1))) == expression_digest(a(_Point(1)))
+        assert expression_digest(a(_Point(1))) != expression_digest(a(_Point(2)))
+        assert ExpressionReference.from_expression(
+            a(_Point(1))
+        ).hash == expression_digest(a(_Point(1)))
+    finally:
+        toggle_digest_hashes(False)
+        # Entries can't be removed from the registry, so restore the default instead
+        hash_value.register(_Point, default_hash_point)
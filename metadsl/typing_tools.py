@@ -4,7 +4,9 @@ import collections.abc
 import copy
 import dataclasses
 import functools
+import importlib
 import inspect
+import itertools
 import logging
 import sys
 import types
@@ -34,6 +36,12 @@ __all__ = [
     "get_origin_type",
     "get_fn_typevars",
     "ToCallable",
+    "InferCache",
+    "infer_cache",
+    "Binder",
+    "bind_arguments",
+    "contains_typevars",
+    "fn_contains_typevars",
 ]
 
 T = typing.TypeVar("T")
@@ -62,12 +70,38 @@ class GenericCheckType(type):
         return super().__subclasscheck__(sub)
 
 
+class _OrigClass:
+    """
+    Descriptor for the `__orig_class__` that `typing` sets on instances created from generic
+    aliases, like `C[int]()`, which stores it in their `_type` instead.
+    """
+
+    def __get__(self, instance, owner=None):
+        if instance is None or instance._type is type(instance):
+            raise AttributeError("__orig_class__")
+        return instance._type
+
+    def __set__(self, instance, value) -> None:
+        instance._type = value
+
+
 class GenericCheck(metaclass=GenericCheckType):
     """
     Subclass this to support isinstance and issubclass checks with generic classes.
+
+    Instances store their type in `_type`, which is the generic alias they were created from,
+    like `C[int]`, or otherwise their class, so that `get_type` only has to read it.
     """
 
-    pass
+    _type: typing.Type
+    __orig_class__ = _OrigClass()
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls._type = cls
+
+
+GenericCheck._type = GenericCheck
 
 
 class OfType(GenericCheck, typing.Generic[T]):
@@ -305,6 +339,8 @@ def get_type(v: T) -> typing.Type[T]:
     """
     Returns the type of the value with generic arguments preserved.
     """
+    if isinstance(v, GenericCheck):
+        return v._type
     if isinstance(v, functools.partial):  # type: ignore
         inner_type = get_type(v.func)  # type: ignore
         if v.keywords:  # type: ignore
@@ -538,7 +574,27 @@ T_type = typing.TypeVar("T_type", bound=typing.Type)
 def replace_typevars(typevars: TypeVarMapping, hint: T_type) -> T_type:
     """
     Replaces type vars in a type hint with other types.
+
+    The results are cached by the hint and the typevars.
     """
+    if not typevars:
+        return hint
+    try:
+        return _replace_typevars_cached(frozenset(typevars.items()), hint)  # type: ignore
+    except TypeError:
+        # Unhashable hint or types
+        return _replace_typevars(typevars, hint)
+
+
+@functools.lru_cache(maxsize=2**12)
+def _replace_typevars_cached(
+    typevars: typing.FrozenSet[typing.Tuple[typing.TypeVar, typing.Type]],
+    hint: T_type,
+) -> T_type:
+    return _replace_typevars(dict(typevars), hint)
+
+
+def _replace_typevars(typevars: TypeVarMapping, hint: T_type) -> T_type:
     if typing_inspect.is_typevar(hint):
         return typing.cast(
             T_type, typevars.get(typing.cast(typing.TypeVar, hint), hint)
@@ -552,15 +608,15 @@ def replace_typevars(typevars: TypeVarMapping, hint: T_type) -> T_type:
         return typing.cast(
             T_type,
             typing.Callable[
-                [replace_typevars(typevars, a) for a in arg_types],
-                replace_typevars(typevars, return_type),
+                [_replace_typevars(typevars, a) for a in arg_types],
+                _replace_typevars(typevars, return_type),
             ],
         )
 
     args = typing_inspect.get_args(hint)
     if not args:
         return hint
-    replaced_args = tuple(replace_typevars(typevars, arg) for arg in args)
+    replaced_args = tuple(_replace_typevars(typevars, arg) for arg in args)
     return get_origin(hint)[replaced_args]
 
 
@@ -574,12 +630,248 @@ def typing_get_type_hints(fn: typing.Callable) -> typing.Dict[str, typing.Type]:
     return typing.get_type_hints(fn)
 
 
+# Marks parameters without defaults in a `Binder`
+_NO_DEFAULT = object()
+
+
+@dataclasses.dataclass(frozen=True)
+class Binder:
+    """
+    The signature of a function, compiled to bind arguments to its parameters without going through
+    `inspect.Signature.bind`.
+
+    It only handles functions without keyword only parameters or variable keyword arguments,
+    and calls that bind every parameter once. `bind` returns None for the rest, so that
+    they can be bound with `inspect` instead, which also raises the right errors.
+    """
+
+    # Names of the parameters that can be passed positionally, with their defaults
+    names: typing.Tuple[str, ...]
+    defaults: typing.Tuple[object, ...]
+    # Number of the parameters at the start of `names` that are positional only
+    n_positional_only: int
+    # Name of the variable positional parameter, if there is one
+    var_positional: typing.Optional[str]
+    # Whether the function has parameters this can't bind
+    supported: bool
+
+    @classmethod
+    def from_signature(cls, signature: inspect.Signature) -> Binder:
+        names: typing.List[str] = []
+        defaults: typing.List[object] = []
+        n_positional_only = 0
+        var_positional: typing.Optional[str] = None
+        supported = True
+        for name, p in signature.parameters.items():
+            if p.kind == inspect.Parameter.VAR_POSITIONAL:
+                var_positional = name
+            elif p.kind in (
+                inspect.Parameter.POSITIONAL_ONLY,
+                inspect.Parameter.POSITIONAL_OR_KEYWORD,
+            ):
+                names.append(name)
+                defaults.append(
+                    _NO_DEFAULT if p.default is inspect.Parameter.empty else p.default
+                )
+                if p.kind == inspect.Parameter.POSITIONAL_ONLY:
+                    n_positional_only += 1
+            else:
+                supported = False
+        return cls(
+            tuple(names),
+            tuple(defaults),
+            n_positional_only,
+            var_positional,
+            supported,
+        )
+
+    def bind(
+        self, args: typing.Tuple[object, ...], kwargs: typing.Mapping[str, object]
+    ) -> typing.Optional[
+        typing.Tuple[typing.Tuple[object, ...], typing.List[typing.Tuple[str, object]]]
+    ]:
+        """
+        Returns the positional arguments to call the function with, with the defaults applied,
+        and the name and value of each argument, with the variable ones repeated once per value.
+        """
+        if not self.supported:
+            return None
+        names = self.names
+        n_positional = len(names)
+        if len(args) > n_positional:
+            if self.var_positional is None or kwargs:
+                return None
+            values = args[:n_positional]
+            items = list(zip(names, values))
+            items += [(self.var_positional, arg) for arg in args[n_positional:]]
+            return args, items
+        if not kwargs and len(args) == n_positional:
+            return args, list(zip(names, args))
+        n_kwargs = 0
+        rest: typing.List[object] = []
+        for i in range(len(args), n_positional):
+            name, default = names[i], self.defaults[i]
+            if name in kwargs:
+                # Positional only parameters can't be passed by keyword
+                if i < self.n_positional_only:
+                    return None
+                rest.append(kwargs[name])
+                n_kwargs += 1
+            elif default is _NO_DEFAULT:
+                return None
+            else:
+                rest.append(default)
+        # Some of the keyword arguments are unknown or were also passed positionally
+        if n_kwargs != len(kwargs):
+            return None
+        values = args + tuple(rest)
+        return values, list(zip(names, values))
+
+
+@functools.lru_cache(maxsize=None)
+def compile_binder(fn: typing.Callable) -> Binder:
+    return Binder.from_signature(inspect_signature(fn))
+
+
+def bind_arguments(
+    fn: typing.Callable,
+    args: typing.Tuple[object, ...],
+    kwargs: typing.Mapping[str, object],
+) -> typing.Tuple[
+    typing.Tuple[object, ...],
+    typing.Mapping[str, object],
+    typing.List[typing.Tuple[str, object]],
+]:
+    """
+    Binds the arguments to the parameters of the function, with the defaults applied.
+
+    Returns the positional and keyword arguments to call it with, like `inspect.BoundArguments`,
+    and the name and value of each argument, with the variable positional ones repeated once per value.
+    """
+    bound_args = compile_binder(fn).bind(args, kwargs)
+    if bound_args is not None:
+        return bound_args[0], {}, bound_args[1]
+
+    signature = inspect_signature(fn)
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+
+    # We need to edit the arguments to pop off the variable one
+    arguments = copy.copy(bound.arguments)
+
+    for arg_name, p in signature.parameters.items():
+        if p.kind == inspect.Parameter.VAR_POSITIONAL:
+            variable_args = arguments.pop(arg_name)
+            argument_items = list(arguments.items())
+            argument_items += [(arg_name, a) for a in variable_args]
+            break
+    else:
+        argument_items = list(arguments.items())
+    return bound.args, bound.kwargs, argument_items
+
+
 def get_arg_hints(fn: typing.Callable) -> typing.List[typing.Type]:
     signature = inspect_signature(fn)
     hints = typing_get_type_hints(fn)
     return [hints[param] for param in signature.parameters.keys()]
 
 
+@dataclasses.dataclass
+class InferCache:
+    """
+    Cache of the typevar mappings and return types computed by `infer_return_type`, keyed by
+    the function, its owner, and the types of the args. Once it is full, the least recently used
+    ones are dropped first.
+
+    Calls with args whose types can't be known from their classes, like functions or tuples,
+    are not cached.
+    """
+
+    max_size: int = 2**14
+    hits: int = 0
+    misses: int = 0
+    _results: typing.OrderedDict[
+        typing.Hashable, typing.Tuple[TypeVarMapping, typing.Type]
+    ] = dataclasses.field(default_factory=collections.OrderedDict, repr=False)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(
+        self, key: typing.Hashable
+    ) -> typing.Optional[typing.Tuple[TypeVarMapping, typing.Type]]:
+        try:
+            result = self._results.get(key)
+        except TypeError:
+            # Some of the types are unhashable
+            return None
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._results.move_to_end(key)
+        return result
+
+    def add(
+        self, key: typing.Hashable, typevars: TypeVarMapping, return_type: typing.Type
+    ) -> None:
+        try:
+            self._results[key] = (typevars, return_type)
+        except TypeError:
+            return
+        if len(self._results) > self.max_size:
+            self._results.popitem(last=False)
+
+    def clear(self) -> None:
+        self._results.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+infer_cache = InferCache()
+
+
+def _arg_type_key(value: object) -> typing.Optional[typing.Hashable]:
+    """
+    Returns what the result of `match_type` for the value depends on, or None if that is
+    more than its class.
+    """
+    if isinstance(value, type) or typing_inspect.get_origin(value):
+        # The value can be matched against a `Type[...]` hint
+        return (type, value)
+    if isinstance(
+        value,
+        (
+            types.FunctionType,
+            functools.partial,
+            tuple,
+            Infer,
+            BoundInfer,
+            FunctionReplaceTyping,
+        ),
+    ):
+        return None
+    return typing_inspect.get_generic_type(value)
+
+
+def _infer_key(
+    fn: typing.Callable,
+    owner: typing.Optional[typing.Type],
+    is_classmethod: bool,
+    args: typing.Tuple[object, ...],
+    kwargs: typing.Mapping[str, object],
+) -> typing.Optional[typing.Hashable]:
+    arg_keys = []
+    for arg in itertools.chain(args, kwargs.values()):
+        arg_key = _arg_type_key(arg)
+        if arg_key is None:
+            return None
+        arg_keys.append(arg_key)
+    return (fn, owner, is_classmethod, tuple(kwargs), *arg_keys)
+
+
 def infer_return_type(
     fn: typing.Callable[..., T],
     owner: typing.Optional[typing.Type],
@@ -595,6 +887,20 @@ def infer_return_type(
     logger.debug(
         "infer_return_type fn=%s owner=%s args=%s kwargs=%s", fn, owner, args, kwargs
     )
+    key = _infer_key(fn, owner, is_classmethod, args, kwargs)
+    cached = infer_cache.get(key) if key is not None else None
+    if cached is not None:
+        # Only the args have to be bound, since their types are the same as before
+        bound_args, bound_kwargs, _ = bind_arguments(
+            fn, (owner, *args) if is_classmethod else args, kwargs
+        )
+        typevars, return_type = cached
+        return (
+            bound_args[1:] if is_classmethod else bound_args,
+            bound_kwargs,
+            return_type,
+            dict(typevars),
+        )
     hints = copy.copy(typing_get_type_hints(fn))
     signature = inspect_signature(fn)
 
@@ -619,20 +925,7 @@ def infer_return_type(
         if first_arg_name not in hints:
             hints[first_arg_name] = first_arg_type  # type: ignore
 
-    bound = signature.bind(*args, **kwargs)
-    bound.apply_defaults()
-
-    # We need to edit the arguments to pop off the variable one
-    arguments = copy.copy(bound.arguments)
-
-    for arg_name, p in signature.parameters.items():
-        if p.kind == inspect.Parameter.VAR_POSITIONAL:
-            variable_args = arguments.pop(arg_name)
-            argument_items = list(arguments.items())
-            argument_items += [(arg_name, a) for a in variable_args]
-            break
-    else:
-        argument_items = list(arguments.items())
+    bound_args, final_kwargs, argument_items = bind_arguments(fn, args, kwargs)
 
     return_hint: typing.Type[T] = hints.pop("return", typing.Any)  # type: ignore
 
@@ -644,8 +937,7 @@ def infer_return_type(
         matches: TypeVarMapping = merge_typevars(*mappings)
     except ValueError:
         raise TypeError(f"Couldn't merge mappings {mappings}")
-    final_args = bound.args[1:] if is_classmethod else bound.args
-    final_kwargs = bound.kwargs
+    final_args = bound_args[1:] if is_classmethod else bound_args
     logger.debug(
         "infer_return_type matches=%s args=%s kwargs=%s", matches, args, kwargs
     )
@@ -653,7 +945,10 @@ def infer_return_type(
         record_scoped_typevars(arg, *matches.keys())
     for kwarg in final_kwargs.values():
         record_scoped_typevars(kwarg, *matches.keys())
-    return (final_args, final_kwargs, replace_typevars(matches, return_hint), matches)
+    return_type = replace_typevars(matches, return_hint)
+    if key is not None:
+        infer_cache.add(key, dict(matches), return_type)
+    return (final_args, final_kwargs, return_type, matches)
 
 
 def record_scoped_typevars(f: object, *additional_typevars: typing.TypeVar) -> None:  # type: ignore
@@ -759,6 +1054,11 @@ class Infer(typing.Generic[T, U]):
     def __repr__(self):
         return getattr(self.fn, "__name__", str(self.fn))
 
+    def __reduce__(self):
+        # Pickle by reference, since the wrapped function can't be found by its name
+        fn = inspect.unwrap(self.fn)
+        return _lookup_qualname, (fn.__module__, fn.__qualname__)
+
 
 SPECIAL_BINARY_METHODS = {
     f"__{n}__"
@@ -817,6 +1117,28 @@ class BoundInfer(typing.Generic[T, U]):
     def __repr__(self):
         return f"{type_repr(self.owner)}.{self.fn.__name__}"
 
+    def __reduce__(self):
+        # Pickle by reference, binding the function from the class to the same owner
+        return _bind_infer, (self.owner, self.fn.__name__)
+
+
+def _lookup_qualname(module: str, qualname: str) -> object:
+    value: object = importlib.import_module(module)
+    for name in qualname.split("."):
+        value = getattr(value, name)
+    return value
+
+
+def _bind_infer(owner: typing.Type, name: str) -> BoundInfer:
+    origin = typing_inspect.get_origin(owner) or owner
+    for cls in inspect.getmro(origin):
+        if name in cls.__dict__:
+            infer = cls.__dict__[name]
+            break
+    else:
+        raise AttributeError(f"{origin} has no attribute {name}")
+    return infer.__get__(None, owner)
+
 
 def type_repr(tp: type) -> str:
     """
@@ -941,6 +1263,26 @@ def replace_fn_typevars(
     return fn
 
 
+@functools.lru_cache(maxsize=2**12)
+def contains_typevars(hint: typing.Type) -> bool:
+    """
+    Returns whether the type hint refers to any typevars, so replacing them could change it.
+    """
+    return typing_inspect.is_typevar(hint) or any(True for _ in get_all_typevars(hint))
+
+
+def fn_contains_typevars(fn: object) -> bool:
+    """
+    Returns whether `replace_fn_typevars` could change the value.
+    """
+    if isinstance(fn, BoundInfer):
+        return contains_typevars(fn.owner)  # type: ignore
+    if isinstance(fn, types.FunctionType):
+        # If it isn't set, let `replace_fn_typevars` raise the error
+        return bool(getattr(fn, "__scoped_typevars__", True))
+    return False
+
+
 def get_fn_typevars(fn: object) -> TypeVarMapping:
     if isinstance(fn, BoundInfer):
         return match_types(get_origin_type(fn.owner), fn.owner)
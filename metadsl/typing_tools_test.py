@@ -1,10 +1,12 @@
 from __future__ import annotations
 
+import inspect
 import sys
 import typing
 
 import pytest
 
+from .dict_tools import HashableMapping
 from .typing_tools import *
 
 T = typing.TypeVar("T")
@@ -265,3 +267,126 @@ class TestGetType:
     def test_bound_infer_classmethod(self):
 
         assert get_type(C[int].create) == typing.Callable[[int], C[int]]
+
+
+class TestInferCache:
+    def test_hits(self):
+        @i
+        def fn(a: T, b: str = "b") -> T:
+            ...
+
+        infer_cache.clear()
+        assert fn(1) == (fn, (1, "b"), {}, int)
+        assert (infer_cache.hits, infer_cache.misses) == (0, 1)
+        assert fn(2) == (fn, (2, "b"), {}, int)
+        assert (infer_cache.hits, infer_cache.misses) == (1, 1)
+        # Different types of args are cached separately
+        assert fn(2.0, b="c") == (fn, (2.0, "c"), {}, float)
+        assert (infer_cache.hits, infer_cache.misses) == (1, 2)
+        assert infer_cache.hit_rate == 1 / 3
+
+    def test_generic_owner(self):
+        infer_cache.clear()
+        assert C[int].create(1)[-1] == C[int]
+        assert C[str].create("a")[-1] == C[str]
+        assert C[int].create(2)[-1] == C[int]
+        assert infer_cache.hits == 1
+
+    def test_uncached_args(self):
+        @i
+        def fn(xs: typing.Sequence[T]) -> T:  # type: ignore
+            ...
+
+        infer_cache.clear()
+        assert fn((1, 2))[-1] == int
+        assert fn(("a",))[-1] == str
+        assert (infer_cache.hits, infer_cache.misses) == (0, 0)
+
+    def test_max_size(self):
+        @i
+        def fn(a: T) -> T:
+            ...
+
+        infer_cache.clear()
+        prev_max_size, infer_cache.max_size = infer_cache.max_size, 1
+        try:
+            fn(1)
+            fn("a")
+            fn(2)
+        finally:
+            infer_cache.max_size = prev_max_size
+        assert (infer_cache.hits, infer_cache.misses) == (0, 3)
+
+
+class TestBindArguments:
+    def test_positional(self):
+        def fn(a, b=2, c=3):
+            ...
+
+        assert bind_arguments(fn, (1,), {"c": 4}) == (
+            (1, 2, 4),
+            {},
+            [("a", 1), ("b", 2), ("c", 4)],
+        )
+
+    def test_var_positional(self):
+        def fn(a, *bs):
+            ...
+
+        assert bind_arguments(fn, (1, 2, 3), {}) == (
+            (1, 2, 3),
+            {},
+            [("a", 1), ("bs", 2), ("bs", 3)],
+        )
+        assert bind_arguments(fn, (1,), {}) == ((1,), {}, [("a", 1)])
+
+    def test_keyword_only(self):
+        """
+        Falls back to binding with inspect
+        """
+
+        def fn(a, *, b=2, **cs):
+            ...
+
+        assert not Binder.from_signature(inspect.signature(fn)).supported
+        assert bind_arguments(fn, (1,), {"d": 4}) == (
+            (1,),
+            {"b": 2, "d": 4},
+            [("a", 1), ("b", 2), ("cs", {"d": 4})],
+        )
+
+    @pytest.mark.parametrize(
+        "args,kwargs", [((), {}), ((1, 2, 3), {}), ((1,), {"a": 1}), ((1,), {"c": 3})]
+    )
+    def test_errors(self, args, kwargs):
+        def fn(a, b=2):
+            ...
+
+        with pytest.raises(TypeError):
+            bind_arguments(fn, args, kwargs)
+
+    def test_positional_only(self):
+        def fn(a, /, b=2):
+            ...
+
+        assert bind_arguments(fn, (1,), {"b": 3}) == ((1, 3), {}, [("a", 1), ("b", 3)])
+        assert Binder.from_signature(inspect.signature(fn)).bind((), {"a": 1}) is None
+        with pytest.raises(TypeError):
+            bind_arguments(fn, (), {"a": 1})
+
+
+class TestReplaceTypevars:
+    def test_cached(self):
+        hint = typing.Callable[[T], typing.Sequence[T]]
+        assert replace_typevars({}, hint) is hint
+        assert (
+            replace_typevars({T: int}, hint)
+            == replace_typevars(HashableMapping({T: int}), hint)
+            == typing.Callable[[int], typing.Sequence[int]]
+        )
+
+    def test_contains_typevars(self):
+        assert contains_typevars(T)
+        assert contains_typevars(typing.Callable[[int], typing.List[T]])
+        assert not contains_typevars(typing.List[int])
+        assert not contains_typevars(int)
@@ -91,19 +91,27 @@ def _replace(body: U, var: T, arg: T) -> U:
     Replaces all instances of `var` with `arg` inside of `body`,
     except for local bindings of `var` as declared in other `from_fn`s inside.
     """
-    if body == var:
-        return arg  # type: ignore
-    if not isinstance(body, Expression):
-        return body
-
-    is_abstraction = (
-        isinstance(body.function, metadsl.typing_tools.BoundInfer)
-        and body.function.fn == Abstraction.create.fn  # type: ignore
+
+    def replace_value(value: object) -> object:
+        if value == var:
+            return arg
+        if not isinstance(value, Expression):
+            return value
+
+        is_abstraction = (
+            isinstance(value.function, metadsl.typing_tools.BoundInfer)
+            and value.function.fn == Abstraction.create.fn  # type: ignore
+        )
+        # If is  a `from_fn` node with the same  var bound, don't try replacing its children
+        if is_abstraction and value.args[0] == var:
+            return value
+        return NotImplemented
+
+    return map_expression(
+        body,
+        lambda expr, args, kwargs: expr._with_children(args, kwargs),
+        replace_value,
     )
-    # If is  a `from_fn` node with the same  var bound, don't try replacing its children
-    if is_abstraction and body.args[0] == var:
-        return body  # type: ignore
-    return body._map(lambda e: _replace(e, var, arg))  # type: ignore
 
 
 @register_core
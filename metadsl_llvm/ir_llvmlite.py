@@ -21,11 +21,15 @@ __all__ = ["mod_str"]
 
 
 @hash_value.register
-def hash_llvmlite_type(value: ir.Type) -> int:
+def hash_llvmlite_type(value: ir.Type) -> bytes:
     """
     Add custom hash for LLVM types, because otherwise they all hash to the same.
+
+    Return it as bytes, so types also have stable digests. The name of the type is included,
+    so that different kinds of types with the same string don't have the same hash.
     """
-    return hash((type(value), value._to_string()))
+    tp = type(value)
+    return f"{tp.__module__}.{tp.__qualname__}:{value._to_string()}".encode()
 
 
 @hash_value.register
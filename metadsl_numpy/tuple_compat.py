@@ -71,6 +71,7 @@ class HomoTupleCompat(Expression, typing.Generic[T, U]):
         self.function = res.function  # type: ignore
         self.args = res.args
         self.kwargs = res.kwargs
+        self._hash = self._without_typevars = None
 
     @expression
     def setitem(self, idx: object, value: object) -> HomoTupleCompat[T, U]:
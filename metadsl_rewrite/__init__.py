@@ -6,9 +6,13 @@ from metadsl import export_from
 
 from .combinators import *  # type: ignore
 from .enum_rule import *  # type: ignore
+from .matchers import *  # type: ignore
 from .normalize import *  # type: ignore
+from .profiling import *  # type: ignore
+from .result_cache import *  # type: ignore
 from .rules import *  # type: ignore
 from .strategies import *  # type: ignore
+from .worklist import *  # type: ignore
 
 strategy = StrategyNormalize()
 execute: Executor = Executor(strategy)
@@ -21,6 +25,10 @@ export_from(
     "strategies",
     "combinators",
     "enum_rule",
+    "matchers",
+    "worklist",
+    "result_cache",
+    "profiling",
     local=["execute", "register"],
 )
 
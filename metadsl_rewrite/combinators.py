@@ -2,9 +2,13 @@ from __future__ import annotations
 
 import dataclasses
 import typing
+import weakref
 
 from metadsl import *
 
+from .matchers import *
+from .profiling import *
+from .rules import Rule
 from .strategies import *
 
 __all__ = [
@@ -13,6 +17,7 @@ __all__ = [
     "StrategyLabel",
     "StrategyRepeat",
     "StrategyInOrder",
+    "StrategyMemo",
 ]
 
 
@@ -27,9 +32,10 @@ class StrategyLabel(Strategy):
 
     def __call__(self, expr: ExpressionReference) -> typing.Iterable[Result]:
         replaced = False
-        for result in self.strategy(expr):
-            replaced = True
-            yield result
+        with profile_phase(self.label):
+            for result in self.strategy(expr):
+                replaced = True
+                yield result
         if replaced:
             yield Result(name=self.label, label=self.label)
 
@@ -63,19 +69,112 @@ class StrategyInOrder(Strategy):
 class StrategySequence(Strategy):
     """
     Returns a new replacement strategy that tries each of the replacement strategies in sequence, returning the result of the first that matches.
+
+    The strategies are indexed by their `heads`, so that each node is only tried against
+    those that can match its head, in the same order. The automata of the rules are also
+    merged into one, so that the function, number of args and kwarg keys of each node are
+    only dispatched on once for all of them, and rules without any templates that could
+    match are skipped.
     """
 
     strategies: typing.Tuple[Strategy, ...]
+    # Mapping of head keys to the strategies to try for them, and the strategies to try
+    # for other keys. Created on the first call.
+    _index: typing.Optional[
+        typing.Tuple[
+            typing.Dict[typing.Hashable, typing.Tuple[Strategy, ...]],
+            typing.Tuple[Strategy, ...],
+        ]
+    ] = dataclasses.field(default=None, repr=False, compare=False)
+    # The automata of the rules merged into one, and a mapping of the ids of the rules to
+    # the index of their automaton in it. Created on the first call.
+    _automaton: typing.Optional[
+        typing.Tuple[MatcherAutomaton, typing.Dict[int, int]]
+    ] = dataclasses.field(default=None, repr=False, compare=False)
 
     def __init__(self, *strategies: Strategy):
         self.strategies = strategies
+        self._index = None
+        self._automaton = None
 
     def __call__(self, expr: ExpressionReference) -> typing.Iterable[Result]:
-        for strategy in self.strategies:
-            for replacement in strategy(expr):
+        value = expr.expression
+        strategies = self._candidates(value)
+        automaton, rule_indices = typing.cast(
+            typing.Tuple[MatcherAutomaton, typing.Dict[int, int]], self._automaton
+        )
+        candidates: typing.Optional[typing.List[int]] = None
+        for strategy in strategies:
+            index = rule_indices.get(id(strategy))
+            if index is None:
+                replacements = strategy(expr)
+            else:
+                if candidates is None:
+                    candidates = automaton.candidates(value)
+                rule_candidates = automaton.split(candidates, index)
+                if not rule_candidates:
+                    continue
+                replacements = typing.cast(Rule, strategy).replace_candidates(
+                    expr, rule_candidates
+                )
+            for replacement in replacements:
                 yield replacement
                 return
 
+    def _candidates(self, value: object) -> typing.Tuple[Strategy, ...]:
+        if self._index is None:
+            self._index = self._create_index()
+            self._automaton = self._create_automaton()
+        by_head, unindexed = self._index
+        try:
+            return by_head.get(head_key(value), unindexed)
+        except TypeError:
+            # The function is unhashable
+            return self.strategies
+
+    def _create_index(
+        self,
+    ) -> typing.Tuple[
+        typing.Dict[typing.Hashable, typing.Tuple[Strategy, ...]],
+        typing.Tuple[Strategy, ...],
+    ]:
+        # Positions of the strategies for each head, and of those that can match any head
+        positions: typing.Dict[typing.Hashable, typing.List[int]] = {}
+        unindexed: typing.List[int] = []
+        for i, strategy in enumerate(self.strategies):
+            heads = getattr(strategy, "heads", None)
+            if heads is not None:
+                try:
+                    heads = frozenset(heads)
+                except TypeError:
+                    # One of the functions is unhashable
+                    heads = None
+            if heads is None:
+                unindexed.append(i)
+                continue
+            for head in heads:
+                positions.setdefault(head, []).append(i)
+        by_head = {
+            head: tuple(self.strategies[i] for i in sorted(head_positions + unindexed))
+            for head, head_positions in positions.items()
+        }
+        return by_head, tuple(self.strategies[i] for i in unindexed)
+
+    def _create_automaton(
+        self,
+    ) -> typing.Tuple[MatcherAutomaton, typing.Dict[int, int]]:
+        automata: typing.List[MatcherAutomaton] = []
+        rule_indices: typing.Dict[int, int] = {}
+        for strategy in self.strategies:
+            if not isinstance(strategy, Rule) or id(strategy) in rule_indices:
+                continue
+            automaton = strategy.automaton
+            # Rules with templates that can't be compiled match them themselves
+            if automaton is not None:
+                rule_indices[id(strategy)] = len(automata)
+                automata.append(automaton)
+        return MatcherAutomaton.merge(automata), rule_indices
+
     def optimize(self, executor, strategy):
         for strategy_ in self.strategies:
             strategy_.optimize(executor, strategy)
@@ -86,15 +185,39 @@ class StrategyFold(Strategy):
     """
     Returns the first replacement found by starting at the top of the expression tree
     and then recursing down into its leaves.
+
+    For each graph, it remembers the nodes that didn't match and the generation of the graph
+    when it looked at them. Those nodes are skipped the next time, unless they have changed
+    since then. Only nodes whose misses all depended just on their descendents are
+    remembered, so those that missed because of other state (which are counted as
+    uncacheable in the `MissCache`) are tried again.
     """
 
     strategy: Strategy
+    # Mapping of graphs to the generation they were last folded in and the nodes that didn't match
+    _unmatched: weakref.WeakKeyDictionary = dataclasses.field(
+        default_factory=weakref.WeakKeyDictionary, init=False, repr=False, compare=False
+    )
 
     def __call__(self, expr: ExpressionReference) -> typing.Iterable[Result]:
+        graph = expr._graph
+        misses = MissCache.of(expr)
+        prev_generation, prev_unmatched = self._unmatched.get(graph, (-1, set()))
+        unmatched: typing.Set[int] = set()
+        self._unmatched[graph] = (graph._generation, unmatched)
         for child_ref in expr.descendents:
+            index = child_ref._index
+            if index in prev_unmatched and not graph._is_changed(
+                index, prev_generation
+            ):
+                unmatched.add(index)
+                continue
+            uncacheable = misses.uncacheable
             for replacement in self.strategy(child_ref):
                 yield replacement
                 return
+            if misses.uncacheable == uncacheable:
+                unmatched.add(index)
 
     def optimize(self, executor, strategy):
         self.strategy.optimize(executor, strategy)
@@ -126,3 +249,21 @@ class StrategyRepeat(Strategy):
         Apply passed in strategy repeatedly.
         """
         self.strategy.optimize(executor, self)
+
+
+@dataclasses.dataclass(frozen=True)
+class StrategyMemo(Strategy):
+    """
+    Replaces a node with the latest form of an equal node that was replaced earlier in the
+    same graph, so it isn't rewritten again from scratch.
+    """
+
+    def __call__(self, expr: ExpressionReference) -> typing.Iterable[Result]:
+        latest = expr._graph._latest_form(expr._index)
+        if latest is None:
+            return
+        expr.replace(latest)
+        yield Result("memo")
+
+    def optimize(self, executor, strategy):
+        pass
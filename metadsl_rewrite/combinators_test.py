@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import dataclasses
+import typing
+
+from metadsl import *
+
+from . import *
+
+
+@expression
+def _leaf(i: int) -> typing.Any:
+    ...
+
+
+@expression
+def _wrap(e: typing.Any) -> typing.Any:
+    ...
+
+
+@expression
+def _pair(l: typing.Any, r: typing.Any) -> typing.Any:
+    ...
+
+
+@dataclasses.dataclass
+class _ReplaceLeaf(Strategy):
+    """
+    Replaces `_leaf(i)` with `_leaf(i + 1)` while `i` is less than three, recording every
+    expression it is called on.
+    """
+
+    calls: typing.List[object] = dataclasses.field(default_factory=list)
+
+    def __call__(self, ref: ExpressionReference) -> typing.Iterable[Result]:
+        self.calls.append(ref.expression)
+        for i in range(3):
+            if ref.expression == _leaf(i):
+                ref.replace(_leaf(i + 1))
+                yield Result("replace leaf")
+                return
+
+    def optimize(self, executor, strategy):
+        pass
+
+
+@dataclasses.dataclass
+class _Record(Strategy):
+    """
+    Records the expressions it is called on, without matching them.
+    """
+
+    heads: typing.Optional[typing.FrozenSet[typing.Hashable]]
+    calls: typing.List[object] = dataclasses.field(default_factory=list)
+
+    def __call__(self, ref: ExpressionReference) -> typing.Iterable[Result]:
+        self.calls.append(ref.expression)
+        return ()
+
+    def optimize(self, executor, strategy):
+        pass
+
+
+class TestStrategySequence:
+    def test_heads(self):
+        wrap, pair, any_, leaf = (
+            _Record(frozenset([_wrap.fn])),
+            _Record(frozenset([_pair.fn])),
+            _Record(None),
+            _Record(frozenset([head_key(1)])),
+        )
+        sequence = StrategySequence(wrap, any_, pair, leaf)
+        ref = ExpressionReference.from_expression(_pair(_wrap(1), 2))
+        for child_ref in ref.descendents:
+            assert list(sequence(child_ref)) == []
+
+        assert wrap.calls == [_wrap(1)]
+        assert pair.calls == [_pair(_wrap(1), 2)]
+        assert sorted(leaf.calls) == [1, 2]
+        assert len(any_.calls) == 4
+
+    def test_order(self):
+        """
+        Strategies should be tried in the order they were passed in
+        """
+        order: typing.List[str] = []
+
+        @dataclasses.dataclass
+        class _Named(_Record):
+            name: str = ""
+
+            def __call__(self, ref):
+                order.append(self.name)
+                return ()
+
+        sequence = StrategySequence(
+            _Named(None, name="a"),
+            _Named(frozenset([_leaf.fn]), name="b"),
+            _Named(None, name="c"),
+        )
+        list(sequence(ExpressionReference.from_expression(_leaf(1))))
+        assert order == ["a", "b", "c"]
+
+    def test_rules(self):
+        """
+        The rules should be matched with one automaton, in order
+        """
+
+        @rule
+        def unwrap(i: int) -> R[typing.Any]:
+            return _wrap(_leaf(i)), _leaf(i)
+
+        @rule
+        def swap(l: object, r: object) -> R[typing.Any]:
+            return _pair(l, r), _pair(r, l)
+
+        @rule
+        def first(r: object) -> R[typing.Any]:
+            return _pair(_leaf(0), r), lambda: _leaf(0)
+
+        sequence = StrategySequence(unwrap, first, swap)
+        ref = ExpressionReference.from_expression(_pair(_leaf(0), _leaf(1)))
+        assert [result.name for result in sequence(ref)] == [str(first)]
+        assert ref.expression == _leaf(0)
+
+        automaton, rule_indices = typing.cast(
+            typing.Tuple[MatcherAutomaton, typing.Dict[int, int]], sequence._automaton
+        )
+        assert automaton.offsets == (0, 1, 2)
+        assert rule_indices == {id(unwrap): 0, id(first): 1, id(swap): 2}
+
+        ref = ExpressionReference.from_expression(_pair(_leaf(1), _leaf(0)))
+        assert [result.name for result in sequence(ref)] == [str(swap)]
+        assert ref.expression == _pair(_leaf(0), _leaf(1))
+
+        ref = ExpressionReference.from_expression(_wrap(_wrap(_leaf(1))))
+        assert list(sequence(ref)) == []
+
+
+class TestStrategyFold:
+    def test_skips_unchanged(self):
+        inner = _ReplaceLeaf()
+        fold = StrategyFold(inner)
+        ref = ExpressionReference.from_expression(_pair(_wrap(_leaf(0)), _leaf(5)))
+
+        assert len(list(fold(ref))) == 1
+        assert ref.expression == _pair(_wrap(_leaf(1)), _leaf(5))
+        inner.calls.clear()
+        # The other leaf, and the values in it, didn't match before and haven't changed
+        assert len(list(fold(ref))) == 1
+        assert _leaf(5) not in inner.calls
+        assert 5 not in inner.calls
+
+        while list(fold(ref)):
+            pass
+        assert ref.expression == _pair(_wrap(_leaf(3)), _leaf(5))
+        inner.calls.clear()
+        # Nothing changed since the last fold, so nothing is looked at again
+        assert list(fold(ref)) == []
+        assert inner.calls == []
+
+    def test_outside_state(self):
+        """
+        Nodes that didn't match because of other state should be tried again
+        """
+        fired: typing.List[str] = []
+
+        @rule
+        def first() -> R[typing.Any]:
+            def inner():
+                fired.append("first")
+                return _leaf(1)
+
+            return _wrap(0), inner
+
+        @rule
+        def second() -> R[typing.Any]:
+            def inner():
+                if not fired:
+                    raise NoMatch
+                return _leaf(2)
+
+            return _wrap(1), inner
+
+        executor = Executor(
+            StrategyRepeat(StrategyFold(StrategySequence(first, second)))
+        )
+        assert executor(_pair(_wrap(0), _wrap(1))) == _pair(_leaf(1), _leaf(2))
+
+    def test_replace_root(self):
+        inner = _ReplaceLeaf()
+        fold = StrategyFold(inner)
+        ref = ExpressionReference.from_expression(_wrap(_leaf(5)))
+        assert list(fold(ref)) == []
+        ref.replace(_wrap(_leaf(2)))
+        assert len(list(fold(ref))) == 1
+        assert ref.expression == _wrap(_leaf(3))
+
+
+class TestStrategyMemo:
+    def test_memo(self):
+        ref = ExpressionReference.from_expression(_pair(_leaf(0), _wrap(1)))
+        (leaf_ref,) = [r for r in ref.descendents if r.expression == _leaf(0)]
+        leaf_ref.replace(_leaf(3))
+        (wrap_ref,) = [r for r in ref.descendents if r.expression == _wrap(1)]
+        wrap_ref.replace(_wrap(_leaf(0)))
+
+        assert [result.name for result in StrategyFold(StrategyMemo())(ref)] == ["memo"]
+        assert ref.expression == _pair(_leaf(3), _wrap(_leaf(3)))
+        assert list(StrategyFold(StrategyMemo())(ref)) == []
@@ -0,0 +1,363 @@
+"""
+Compiles the templates of rules into matchers, so that matching a node against a template
+doesn't have to walk the template generically.
+
+Each template is flattened once into a list of steps, one per node in the template, in pre order.
+Matching first runs through the steps checking the functions, number of args and kwarg keys
+of each node, and binding the wildcards into a flat list. Only if all of those pass are the types
+matched, which is much more expensive.
+
+Several matchers can be combined into an automaton, which dispatches on the function, number
+of args and kwarg keys of the root node, so only the templates that could match it are tried.
+The automata of several rules can also be merged into one, so that those checks are done once
+for all of them.
+"""
+from __future__ import annotations
+
+import bisect
+import dataclasses
+import typing
+
+from metadsl import *
+from metadsl.typing_tools import *
+
+from .strategies import *
+
+__all__ = ["Matcher", "MatcherAutomaton", "CannotCompile", "compile_template"]
+
+
+class CannotCompile(Exception):
+    """
+    Raised when a template cannot be compiled, so it has to be matched generically instead.
+    """
+
+
+# The kinds of steps
+_EXPRESSION = 0
+_WILDCARD = 1
+_VALUE = 2
+
+
+@dataclasses.dataclass
+class Matcher:
+    """
+    A template compiled against a list of wildcards.
+
+    The steps are tuples that start with the kind of step. Each step also is a register, which
+    holds the node the step matches, and is filled in by the step of its parent:
+
+    * `(_EXPRESSION, function, head, n_args, kwarg_keys, iterated_index, children)`
+    * `(_WILDCARD, wildcard, slot)`
+    * `(_VALUE, value)`
+    """
+
+    template: object
+    wildcards: typing.Sequence[object]
+    # The head key of the template, or None if it is a wildcard and can match any node
+    head: typing.Optional[typing.Hashable]
+    # The number of args the root has to have, or None if it can have any number
+    n_args: typing.Optional[int]
+    # The kwarg keys the root has to have, or None if it is a wildcard
+    kwarg_keys: typing.Optional[typing.FrozenSet[str]]
+    # The indices of the wildcards that are bound by the template
+    slots: typing.Tuple[int, ...]
+    steps: typing.List[typing.Tuple] = dataclasses.field(repr=False)
+
+    def match(
+        self, expr: object
+    ) -> typing.Optional[typing.Tuple[TypeVarMapping, typing.List[object]]]:
+        """
+        Matches the expression, returning None if it doesn't match.
+
+        Otherwise returns the typevar mapping and a list of the nodes bound to each wildcard.
+        The wildcards that are not in the template are bound to themselves.
+        """
+        bindings = self._match_structure(expr)
+        if bindings is None:
+            return None
+        values, bound = bindings
+        typevars = self._match_types(values)
+        if typevars is None:
+            return None
+        return typevars, bound
+
+    def _match_structure(
+        self, expr: object
+    ) -> typing.Optional[typing.Tuple[typing.List[object], typing.List[object]]]:
+        steps = self.steps
+        values: typing.List[object] = [None] * len(steps)
+        values[0] = expr
+        bound = list(self.wildcards)
+        is_bound = [False] * len(bound)
+        for i, step in enumerate(steps):
+            value = values[i]
+            kind = step[0]
+            if kind == _WILDCARD:
+                slot = step[2]
+                if not is_bound[slot]:
+                    bound[slot] = value
+                    is_bound[slot] = True
+                elif bound[slot] != value:
+                    return None
+            elif kind == _VALUE:
+                if isinstance(value, Expression) or step[1] != value:
+                    return None
+            else:
+                _, _, head, n_args, kwarg_keys, iterated_index, children = step
+                if not isinstance(value, Expression) or head_key(value) != head:
+                    return None
+                args = value.args
+                kwargs = value.kwargs
+                if len(kwargs) != len(kwarg_keys) or any(
+                    key not in kwargs for key in kwarg_keys
+                ):
+                    return None
+                if iterated_index < 0:
+                    if len(args) != n_args:
+                        return None
+                    child_values: typing.List[object] = list(args)
+                else:
+                    # The iterated placeholder takes all the args between the ones
+                    # before and after it in the template
+                    if len(args) < n_args - 1:
+                        return None
+                    n_right = n_args - iterated_index - 1
+                    end = len(args) - n_right
+                    child_values = [
+                        *args[:iterated_index],
+                        tuple(args[iterated_index:end]),
+                        *args[end:],
+                    ]
+                child_values.extend(kwargs[key] for key in kwarg_keys)
+                for child, child_value in zip(children, child_values):
+                    values[child] = child_value
+        return values, bound
+
+    def _match_types(
+        self, values: typing.List[object]
+    ) -> typing.Optional[TypeVarMapping]:
+        """
+        Matches the types of the nodes against the template, from the leaves up, merging
+        the mappings of children into their parents like `match_expression` does.
+        """
+        steps = self.steps
+        mappings: typing.List[TypeVarMapping] = [{}] * len(steps)
+        for i in reversed(range(len(steps))):
+            step = steps[i]
+            kind = step[0]
+            value = values[i]
+            if kind == _WILDCARD:
+                try:
+                    mappings[i] = match_values(step[1], value)
+                except TypeError:
+                    return None
+            elif kind == _VALUE:
+                mappings[i] = match_values(step[1], value)
+            else:
+                try:
+                    mappings[i] = merge_typevars(
+                        match_functions(step[1], value.function),  # type: ignore
+                        *(mappings[child] for child in step[6]),
+                    )
+                except TypeError:
+                    return None
+        return mappings[0]
+
+
+def compile_template(wildcards: typing.Sequence[object], template: object) -> Matcher:
+    """
+    Compiles a template, with the wildcards in it, into a matcher.
+
+    Raises a CannotCompile if the template cannot be compiled, because a node in it
+    has more than one iterated placeholder.
+    """
+    steps: typing.List[typing.Tuple] = []
+    slots: typing.Set[int] = set()
+    # Stack of (template node, index of its step)
+    stack: typing.List[typing.Tuple[object, int]] = [(template, 0)]
+    steps.append(())
+    while stack:
+        node, index = stack.pop()
+        slot = _wildcard_slot(wildcards, node)
+        if slot is not None:
+            slots.add(slot)
+            steps[index] = (_WILDCARD, node, slot)
+            continue
+        if not isinstance(node, Expression):
+            steps[index] = (_VALUE, node)
+            continue
+        args = list(node.args)
+        iterated = [
+            i for i, arg in enumerate(args) if isinstance(arg, IteratedPlaceholder)
+        ]
+        if len(iterated) > 1:
+            raise CannotCompile(f"Only one iterated placeholder is supported in {node}")
+        iterated_index = iterated[0] if iterated else -1
+        if iterated:
+            # Match the inner wildcard against the collapsed args
+            (args[iterated_index],) = typing.cast(Expression, args[iterated_index]).args
+        kwarg_keys = tuple(node.kwargs.keys())
+        child_nodes = [*args, *(node.kwargs[key] for key in kwarg_keys)]
+        children = tuple(range(len(steps), len(steps) + len(child_nodes)))
+        steps.extend(() for _ in child_nodes)
+        steps[index] = (
+            _EXPRESSION,
+            node.function,
+            head_key(node),
+            len(args),
+            kwarg_keys,
+            iterated_index,
+            children,
+        )
+        # Push in reverse so that the children are visited in order
+        stack.extend(reversed(list(zip(child_nodes, children))))
+    root = steps[0]
+    return Matcher(
+        template=template,
+        wildcards=wildcards,
+        head=None if root[0] == _WILDCARD else head_key(template),
+        n_args=root[3] if root[0] == _EXPRESSION and root[5] < 0 else None,
+        kwarg_keys=frozenset(root[4]) if root[0] == _EXPRESSION else None,
+        slots=tuple(sorted(slots)),
+        steps=steps,
+    )
+
+
+def _wildcard_slot(
+    wildcards: typing.Sequence[object], node: object
+) -> typing.Optional[int]:
+    for i, wildcard in enumerate(wildcards):
+        if wildcard is node or (isinstance(node, Expression) and wildcard == node):
+            return i
+    return None
+
+
+# The kwarg keys of nodes without kwargs
+_NO_KWARGS: typing.FrozenSet[str] = frozenset()
+
+
+@dataclasses.dataclass
+class MatcherAutomaton:
+    """
+    Combines several matchers, so that a node is only matched against those whose root
+    has the same function, number of args and kwarg keys.
+    """
+
+    matchers: typing.Sequence[Matcher]
+    # The index of the first matcher of each automaton this was merged from, see `merge`
+    offsets: typing.Tuple[int, ...] = (0,)
+    # Mapping of the (head, number of args, kwarg keys) of nodes to the indices of the
+    # matchers to try, in the order they were passed in.
+    _by_key: typing.Dict[
+        typing.Tuple[typing.Hashable, int, typing.FrozenSet[str]], typing.List[int]
+    ] = dataclasses.field(init=False, repr=False)
+    # The indices of the matchers that aren't indexed by their number of args,
+    # keyed by head, with the wildcard rooted ones under None.
+    _by_head: typing.Dict[typing.Hashable, typing.List[int]] = dataclasses.field(
+        init=False, repr=False
+    )
+    # Indices of the matchers that must be tried on every node, because their heads are unhashable
+    _unindexed: typing.List[int] = dataclasses.field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._by_key = {}
+        self._by_head = {}
+        self._unindexed = []
+        for i, matcher in enumerate(self.matchers):
+            try:
+                hash(matcher.head)
+            except TypeError:
+                self._unindexed.append(i)
+                continue
+            if matcher.n_args is None:
+                self._by_head.setdefault(matcher.head, []).append(i)
+            else:
+                # Roots with a number of args are expressions, so they have kwarg keys
+                key = (
+                    matcher.head,
+                    matcher.n_args,
+                    typing.cast(typing.FrozenSet[str], matcher.kwarg_keys),
+                )
+                self._by_key.setdefault(key, []).append(i)
+
+    @classmethod
+    def merge(cls, automata: typing.Sequence[MatcherAutomaton]) -> MatcherAutomaton:
+        """
+        Merges several automata into one, which has the matchers of each of them in order.
+
+        The matchers of the `i`th automaton start at `offsets[i]`, so the indices it returns
+        can be mapped back with `origin` and `split`.
+        """
+        offsets = []
+        matchers: typing.List[Matcher] = []
+        for automaton in automata:
+            offsets.append(len(matchers))
+            matchers.extend(automaton.matchers)
+        return cls(matchers, tuple(offsets))
+
+    def origin(self, i: int) -> typing.Tuple[int, int]:
+        """
+        Returns the index of the automaton that the matcher at `i` was merged from, and its
+        index in that automaton.
+        """
+        automaton = bisect.bisect_right(self.offsets, i) - 1
+        return automaton, i - self.offsets[automaton]
+
+    def split(self, candidates: typing.List[int], automaton: int) -> typing.List[int]:
+        """
+        Returns the candidates from one of the automata this was merged from, as indices in it.
+        """
+        start = self.offsets[automaton]
+        end = (
+            self.offsets[automaton + 1]
+            if automaton + 1 < len(self.offsets)
+            else len(self.matchers)
+        )
+        return [
+            i - start
+            for i in candidates[
+                bisect.bisect_left(candidates, start) : bisect.bisect_left(
+                    candidates, end
+                )
+            ]
+        ]
+
+    def candidates(self, expr: object) -> typing.List[int]:
+        """
+        Returns the indices of the matchers that could match the expression, in order.
+        """
+        head = head_key(expr)
+        try:
+            groups = [self._by_head.get(head, [])]
+            if isinstance(expr, Expression):
+                kwargs = expr.kwargs
+                groups.append(
+                    self._by_key.get(
+                        (
+                            head,
+                            len(expr.args),
+                            frozenset(kwargs) if kwargs else _NO_KWARGS,
+                        ),
+                        [],
+                    )
+                )
+        except TypeError:
+            # The head of the expression is unhashable, so only compare it to those which are
+            groups = []
+        groups.append(self._by_head.get(None, []))
+        groups.append(self._unindexed)
+        groups = [group for group in groups if group]
+        if len(groups) == 1:
+            return groups[0]
+        return sorted(i for group in groups for i in group)
+
+    def match(
+        self, expr: object
+    ) -> typing.Iterator[typing.Tuple[int, TypeVarMapping, typing.List[object]]]:
+        """
+        Yields the index, typevars and bound wildcards of every matcher that matches the expression, in order.
+        """
+        for i in self.candidates(expr):
+            res = self.matchers[i].match(expr)
+            if res is not None:
+                yield (i, *res)
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import typing
+
+import pytest
+
+from metadsl import *
+
+from . import *
+from .rules import create_wildcard
+
+T = typing.TypeVar("T")
+
+
+class _List(Expression, typing.Generic[T]):
+    @expression
+    @classmethod
+    def create(cls, *items: T) -> _List[T]:
+        ...
+
+    @expression
+    def __add__(self, other: _List[T]) -> _List[T]:
+        ...
+
+
+@expression
+def _pair(l: object, r: object) -> object:
+    ...
+
+
+a = create_wildcard(int)
+b = create_wildcard(int)
+wildcards = [a, b]
+
+
+class TestMatcher:
+    def test_binds_wildcards(self):
+        matcher = compile_template(wildcards, _pair(a, b))
+        assert matcher.slots == (0, 1)
+        res = matcher.match(_pair(1, 2))
+        assert res
+        _, bound = res
+        assert bound == [1, 2]
+
+    def test_unbound_wildcards(self):
+        matcher = compile_template(wildcards, _pair(a, 10))
+        assert matcher.slots == (0,)
+        assert matcher.match(_pair(1, 10)) == ({}, [1, b])
+        assert matcher.match(_pair(1, 11)) is None
+
+    def test_repeated_wildcard(self):
+        matcher = compile_template(wildcards, _pair(a, a))
+        assert matcher.match(_pair(1, 1))
+        assert matcher.match(_pair(1, 2)) is None
+
+    def test_structure(self):
+        matcher = compile_template(wildcards, _pair(_pair(a, b), a))
+        assert matcher.match(_pair(1, 2)) is None
+        assert matcher.match(_pair(_pair(1, 2), 1))
+        assert matcher.match(_List[int].create(1, 2)) is None
+        assert matcher.match(1) is None
+
+    def test_types(self):
+        matcher = compile_template(wildcards, _pair(a, b))
+        assert matcher.match(_pair(1, "not an int")) is None
+
+    def test_typevars(self):
+        l = create_wildcard(_List[T])
+        r = create_wildcard(_List[T])
+        matcher = compile_template([l, r], l + r)
+        res = matcher.match(_List[int].create(1) + _List[int].create(2))
+        assert res
+        typevars, _ = res
+        assert typevars == {T: int}
+
+    def test_iterated(self):
+        items = create_wildcard(typing.Sequence[int])
+        matcher = compile_template([items, a], _List[int].create(a, *items))
+        assert matcher.n_args is None
+        res = matcher.match(_List[int].create(1, 2, 3))
+        assert res
+        _, bound = res
+        assert bound == [(2, 3), 1]
+        assert matcher.match(_List[int].create()) is None
+
+    def test_cannot_compile(self):
+        items = create_wildcard(typing.Sequence[int])
+        other_items = create_wildcard(typing.Sequence[int])
+        with pytest.raises(CannotCompile):
+            compile_template(
+                [items, other_items], _List[int].create(*items, *other_items)
+            )
+
+
+class TestMatcherAutomaton:
+    def test_dispatch(self):
+        any_ = create_wildcard(object)
+        automaton = MatcherAutomaton(
+            [
+                compile_template(wildcards, _pair(a, b)),
+                compile_template([any_], any_),
+                compile_template(wildcards, _pair(a, 1)),
+                compile_template(wildcards, _List[int].create(a, b)),
+            ]
+        )
+        assert automaton.candidates(_pair(1, 2)) == [0, 1, 2]
+        assert automaton.candidates(_List[int].create(1)) == [1]
+        assert automaton.candidates(10) == [1]
+        assert [i for i, *_ in automaton.match(_pair(1, 2))] == [0, 1]
+        assert [i for i, *_ in automaton.match(_List[int].create(1, 2))] == [1, 3]
+        assert [i for i, *_ in automaton.match(_pair(1, 1))] == [0, 1, 2]
+
+    def test_kwargs(self):
+        # Calling the function binds kwargs to args, so create the nodes directly
+        automaton = MatcherAutomaton(
+            [
+                compile_template(wildcards, _pair(a, b)),
+                compile_template(wildcards, Expression(_pair, [a], {"r": b})),
+            ]
+        )
+        assert automaton.candidates(_pair(1, 2)) == [0]
+        assert automaton.candidates(Expression(_pair, [1], {"r": 2})) == [1]
+        assert automaton.candidates(Expression(_pair, [1], {"l": 2})) == []
+
+    def test_merge(self):
+        first = MatcherAutomaton([compile_template(wildcards, _pair(a, b))])
+        second = MatcherAutomaton(
+            [
+                compile_template(wildcards, _pair(a, 1)),
+                compile_template(wildcards, _List[int].create(a, b)),
+            ]
+        )
+        merged = MatcherAutomaton.merge([first, second])
+        assert merged.offsets == (0, 1)
+
+        candidates = merged.candidates(_pair(1, 1))
+        assert candidates == [0, 1]
+        assert merged.split(candidates, 0) == [0]
+        assert merged.split(candidates, 1) == [0]
+        assert [merged.origin(i) for i, *_ in merged.match(_pair(1, 1))] == [
+            (0, 0),
+            (1, 0),
+        ]
+
+        candidates = merged.candidates(_List[int].create(1, 2))
+        assert merged.split(candidates, 0) == []
+        assert merged.split(candidates, 1) == [1]
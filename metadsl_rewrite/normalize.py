@@ -78,6 +78,8 @@ class StrategyNormalize(Strategy):
     phases: typing.DefaultDict[str, typing.Set[Strategy]] = dataclasses.field(
         default_factory=lambda: collections.defaultdict(set)
     )
+    # Whether to replace nodes with the latest form of equal nodes that were already rewritten
+    memo: bool = False
 
     def __call__(self, expr: ExpressionReference) -> typing.Iterable[Result]:
         return self.strategy(expr)
@@ -97,6 +99,15 @@ class StrategyNormalize(Strategy):
         #     )
         # return dataclasses.replace(self, phases=new_phases)
 
+    @property
+    def pre_strategy(self) -> StrategySequence:
+        """
+        The strategies in pre, after the memo if it is enabled.
+        """
+        if self.memo:
+            return StrategySequence(StrategyMemo(), *self.pre)
+        return StrategySequence(*self.pre)
+
     @property
     def phase_strategies(self) -> typing.Iterable[Strategy]:
         current_strategies: typing.Set[Strategy] = set()
@@ -106,7 +117,7 @@ class StrategyNormalize(Strategy):
                 label,
                 StrategyRepeat(
                     StrategySequence(
-                        StrategyFold(StrategySequence(*self.pre)),
+                        StrategyFold(self.pre_strategy),
                         StrategyFold(StrategySequence(*current_strategies)),
                     )
                 ),
@@ -116,9 +127,7 @@ class StrategyNormalize(Strategy):
     def strategy(self) -> Strategy:
         return StrategyRepeat(
             StrategyInOrder(
-                StrategyLabel(
-                    "pre", StrategyRepeat(StrategyFold(StrategySequence(*self.pre)))
-                ),
+                StrategyLabel("pre", StrategyRepeat(StrategyFold(self.pre_strategy))),
                 *self.phase_strategies,
                 StrategyLabel("post", StrategyFold(StrategySequence(*self.post))),
             )
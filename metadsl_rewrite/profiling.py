@@ -0,0 +1,239 @@
+"""
+Profiling of executions, to find which rules take up the time.
+
+Pass a `Profile` to an executor, and while it executes each rule records how often it was tried,
+how often it matched, the time spent matching and building replacements, and how many nodes its
+replacements added to the graph, under the phase of the `StrategyNormalize` it ran in:
+
+    >>> from metadsl_rewrite import Executor, StrategyNormalize
+    >>> profile = Profile()
+    >>> executor = Executor(StrategyNormalize(), profile=profile)
+    >>> print(profile.report())
+    phase  rule  attempts  matches  match (s)  build (s)  growth
+"""
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import dataclasses
+import time
+import typing
+
+from metadsl import *
+
+if typing.TYPE_CHECKING:
+    from .strategies import Result
+
+__all__ = [
+    "Profile",
+    "RuleProfile",
+    "RuleTimer",
+    "profiling",
+    "profile_phase",
+    "profile_rule",
+    "current_profile",
+]
+
+
+@dataclasses.dataclass
+class RuleProfile:
+    """
+    What one rule did in one phase.
+    """
+
+    attempts: int = 0
+    matches: int = 0
+    # Seconds spent matching, including attempts that didn't match
+    match_time: float = 0.0
+    # Seconds spent building replacements and replacing with them
+    build_time: float = 0.0
+    # Number of nodes the replacements added to the graph, which is negative if they removed some
+    growth: int = 0
+
+    @property
+    def total_time(self) -> float:
+        return self.match_time + self.build_time
+
+    def add(self, other: RuleProfile) -> None:
+        self.attempts += other.attempts
+        self.matches += other.matches
+        self.match_time += other.match_time
+        self.build_time += other.build_time
+        self.growth += other.growth
+
+
+@dataclasses.dataclass
+class Profile:
+    """
+    Profiles of rules, by the phase they ran in and the name of the rule.
+    """
+
+    rules: typing.Dict[typing.Tuple[str, str], RuleProfile] = dataclasses.field(
+        default_factory=dict
+    )
+    # The label of the phase that is running
+    phase: str = ""
+
+    def rule(self, name: str) -> RuleProfile:
+        """
+        Returns the profile of the rule in the current phase.
+        """
+        key = (self.phase, name)
+        profile = self.rules.get(key)
+        if profile is None:
+            profile = self.rules[key] = RuleProfile()
+        return profile
+
+    def by_rule(self) -> typing.Dict[str, RuleProfile]:
+        """
+        Returns the profiles of the rules, summed over all phases.
+        """
+        totals: typing.Dict[str, RuleProfile] = {}
+        for (_, name), profile in self.rules.items():
+            totals.setdefault(name, RuleProfile()).add(profile)
+        return totals
+
+    def by_phase(self) -> typing.Dict[str, RuleProfile]:
+        """
+        Returns the profiles of the phases, summed over all rules.
+        """
+        totals: typing.Dict[str, RuleProfile] = {}
+        for (phase, _), profile in self.rules.items():
+            totals.setdefault(phase, RuleProfile()).add(profile)
+        return totals
+
+    def report(
+        self, sort: str = "total_time", limit: typing.Optional[int] = None
+    ) -> str:
+        """
+        Returns a table of the profiles of the rules in each phase, sorted by one of the fields
+        of `RuleProfile` from largest to smallest.
+        """
+        rows = sorted(
+            self.rules.items(), key=lambda item: getattr(item[1], sort), reverse=True
+        )[:limit]
+        table = [
+            ["phase", "rule", "attempts", "matches", "match (s)", "build (s)", "growth"]
+        ] + [
+            [
+                phase,
+                name,
+                str(profile.attempts),
+                str(profile.matches),
+                f"{profile.match_time:.6f}",
+                f"{profile.build_time:.6f}",
+                str(profile.growth),
+            ]
+            for (phase, name), profile in rows
+        ]
+        widths = [max(len(row[i]) for row in table) for i in range(len(table[0]))]
+        return "\n".join(
+            "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+            for row in table
+        )
+
+    def reset(self) -> None:
+        self.rules.clear()
+
+
+class RuleTimer:
+    """
+    Times one call of a rule, recording it in the profile of the rule.
+
+    The rule calls `build` once it starts building a replacement, which ends the time spent matching.
+    """
+
+    def __init__(self, profile: RuleProfile, ref: ExpressionReference):
+        self.profile = profile
+        self.graph = ref._graph
+        self.size = len(self.graph)
+        self.start = time.perf_counter()
+        self.build_start: typing.Optional[float] = None
+        profile.attempts += 1
+
+    def build(self) -> None:
+        if self.build_start is None:
+            self.build_start = time.perf_counter()
+
+    def finish(self, matched: bool) -> None:
+        end = time.perf_counter()
+        build_start = end if self.build_start is None else self.build_start
+        profile = self.profile
+        profile.match_time += build_start - self.start
+        profile.build_time += end - build_start
+        if matched:
+            profile.matches += 1
+            profile.growth += len(self.graph) - self.size
+
+
+def profile_rule(
+    rule: object,
+    ref: ExpressionReference,
+    call: typing.Callable[
+        [ExpressionReference, typing.Optional[RuleTimer]], typing.Iterable[Result]
+    ],
+) -> typing.Iterable[Result]:
+    """
+    Calls a rule with a timer, if it is being profiled, and otherwise without one.
+    """
+    profile = _current.get()
+    if profile is None:
+        return call(ref, None)
+    return _profiled(RuleTimer(profile.rule(str(rule)), ref), ref, call)
+
+
+def _profiled(
+    timer: RuleTimer,
+    ref: ExpressionReference,
+    call: typing.Callable[
+        [ExpressionReference, typing.Optional[RuleTimer]], typing.Iterable[Result]
+    ],
+) -> typing.Iterable[Result]:
+    for result in call(ref, timer):
+        # Stop timing before yielding, so it doesn't include what is done with the result
+        timer.finish(True)
+        yield result
+        return
+    timer.finish(False)
+
+
+# The profile of the execution that is running in this context, if it is being profiled
+_current: contextvars.ContextVar[typing.Optional[Profile]] = contextvars.ContextVar(
+    "current_profile", default=None
+)
+
+
+def current_profile() -> typing.Optional[Profile]:
+    """
+    Returns the profile that rules should record to, or None if they aren't being profiled.
+    """
+    return _current.get()
+
+
+@contextlib.contextmanager
+def profiling(profile: typing.Optional[Profile]) -> typing.Iterator[None]:
+    """
+    Records to the profile while in the context, or stops recording if it is None.
+    """
+    token = _current.set(profile)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def profile_phase(label: str) -> typing.Iterator[None]:
+    """
+    Records the rules run in the context under this phase, if they are being profiled.
+    """
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    prev = profile.phase
+    profile.phase = label
+    try:
+        yield
+    finally:
+        profile.phase = prev
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import threading
+import typing
+
+from metadsl import *
+
+from . import *
+from .testing import *
+
+
+def _normalize() -> StrategyNormalize:
+    normalize = StrategyNormalize()
+    normalize.phases["double"].add(double_rule)
+    normalize.phases["add"].add(add_rule)
+    return normalize
+
+
+class TestProfile:
+    def test_records_rules_by_phase(self):
+        profile = Profile()
+        executor = Executor(_normalize(), profile=profile)
+        assert executor(from_int(1).double().double()) == from_int(4)
+
+        double = profile.rules[("double", str(double_rule))]
+        assert double.matches == 2
+        assert double.attempts >= double.matches
+        assert double.total_time > 0
+
+        # Both 1 + 1 are the same node, so they are replaced once
+        add = profile.rules[("add", str(add_rule))]
+        assert add.matches == 2
+        # Each addition replaces three nodes with one
+        assert add.growth < 0
+
+        assert profile.by_rule()[str(add_rule)].matches == 2
+        assert profile.by_phase()["double"].matches == 2
+
+    def test_worklist(self):
+        profile = Profile()
+        executor = Executor(_normalize(), execute_worklist, profile=profile)
+        assert executor(from_int(1).double().double()) == from_int(4)
+        assert profile.rules[("double", str(double_rule))].matches == 2
+        assert profile.rules[("add", str(add_rule))].matches == 2
+
+    def test_report(self):
+        profile = Profile()
+        executor = Executor(_normalize(), profile=profile)
+        executor(from_int(1).double())
+        header, *rows = profile.report(sort="matches").splitlines()
+        assert header.split() == [
+            "phase",
+            "rule",
+            "attempts",
+            "matches",
+            "match",
+            "(s)",
+            "build",
+            "(s)",
+            "growth",
+        ]
+        assert [row.split()[:2] for row in rows[:2]] == [
+            ["double", str(double_rule)],
+            ["add", str(add_rule)],
+        ]
+        assert len(profile.report(limit=1).splitlines()) == 2
+
+    def test_not_profiling(self):
+        profile = Profile()
+        Executor(_normalize())(from_int(1).double())
+        assert current_profile() is None
+        assert not profile.rules
+
+    def test_threads(self):
+        """
+        Executors in different threads should record to their own profiles
+        """
+        first, second = Profile(), Profile()
+        paused, resume = threading.Event(), threading.Event()
+        seen: typing.List[typing.Optional[Profile]] = []
+
+        def pause():
+            paused.set()
+            resume.wait(10)
+            seen.append(current_profile())
+
+        thread = threading.Thread(
+            target=Executor(CallStrategy(pause), profile=first), args=(from_int(1),)
+        )
+        thread.start()
+        paused.wait(10)
+
+        def run_other():
+            resume.set()
+            thread.join(10)
+
+        Executor(CallStrategy(run_other), profile=second)(from_int(1))
+        # Empty profiles are equal, so compare them by identity
+        assert len(seen) == 1
+        assert seen[0] is first
@@ -0,0 +1,207 @@
+"""
+Caches the results of executing expressions across calls of an executor, so that executing
+an expression that was already executed with the same strategy skips rewriting entirely.
+"""
+from __future__ import annotations
+
+import collections
+import dataclasses
+import hashlib
+import pickle
+import sqlite3
+import threading
+import types
+import typing
+
+from metadsl import *
+
+from .normalize import *
+from .strategies import *
+
+__all__ = ["ResultCache", "strategy_fingerprint"]
+
+
+# Changed whenever the format of the keys or of the stored results changes, so that results
+# stored by earlier versions aren't used
+_FORMAT_VERSION = 1
+
+
+def strategy_fingerprint(strategy: Strategy) -> str:
+    """
+    Returns a string that identifies a strategy by the names and the code of all the rules in
+    it, which is the same in every process.
+
+    Raises a TypeError if one of them can't be identified by its name, like rules defined
+    inside a function.
+    """
+    return repr((_FORMAT_VERSION, _fingerprint(strategy)))
+
+
+def _fingerprint(strategy: Strategy) -> str:
+    if isinstance(strategy, StrategyNormalize):
+        return repr(
+            (
+                strategy.memo,
+                sorted(map(_fingerprint, strategy.pre)),
+                [
+                    (label, sorted(map(_fingerprint, strategies)))
+                    for label, strategies in strategy.phases.items()
+                ],
+                sorted(map(_fingerprint, strategy.post)),
+            )
+        )
+    name = str(strategy)
+    if "<locals>" in name or "<lambda>" in name or " at 0x" in name:
+        raise TypeError(f"Cannot fingerprint {name}, since it has no unique name")
+    # The function of a `Rule` or the body of a `DefaultRule`
+    fn = getattr(strategy, "matchfunction", getattr(strategy, "inner_fn", None))
+    if isinstance(fn, types.FunctionType):
+        return f"{name}:{_code_digest(fn.__qualname__, fn.__code__)}"
+    return name
+
+
+def _code_digest(name: str, code: types.CodeType) -> str:
+    """
+    Returns a digest of the code of a function, including the functions defined in it.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(name.encode())
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    digest.update(_encode_const(code.co_consts).encode())
+    return digest.hexdigest()
+
+
+def _encode_const(value: object) -> str:
+    if isinstance(value, types.CodeType):
+        return _code_digest(value.co_name, value)
+    if isinstance(value, (tuple, frozenset)):
+        items = [_encode_const(item) for item in value]
+        if isinstance(value, frozenset):
+            items.sort()
+        return f"{type(value).__name__}({','.join(items)})"
+    return repr(value)
+
+
+@dataclasses.dataclass
+class ResultCache:
+    """
+    Caches results by a digest of the expression and the fingerprint of the strategy.
+
+    Results are kept in memory, dropping the least recently used ones once there are more than
+    `max_size`. If a `path` is passed, they are also stored in a sqlite database there, which
+    outlasts the process. The cache can be used by executors in several threads at once.
+
+    Rules are identified by their names and their code, so results are not reused once the code
+    of a rule changes. The database still has to be cleared when other functions they call change.
+
+    Expressions or strategies that can't be identified by their contents are not cached. Neither
+    are results that contain values which can't be, like variables, since they would be shared
+    between the results of different calls.
+    """
+
+    max_size: int = 1024
+    path: typing.Optional[str] = None
+
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+
+    _memory: typing.OrderedDict[str, object] = dataclasses.field(
+        default_factory=collections.OrderedDict, init=False, repr=False
+    )
+    _db: typing.Optional[sqlite3.Connection] = dataclasses.field(
+        default=None, init=False, repr=False
+    )
+    # Held while using the results in memory or the database, which is shared between threads
+    _lock: threading.Lock = dataclasses.field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+
+    def __post_init__(self):
+        if self.path is not None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            with self._db:
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB)"
+                )
+
+    def key(self, expr: object, strategy: Strategy) -> typing.Optional[str]:
+        """
+        Returns the key to cache the result of executing the expression with the strategy,
+        or None if it can't be cached.
+        """
+        try:
+            contents = expression_digest(expr) + strategy_fingerprint(strategy)
+        except TypeError:
+            return None
+        return hashlib.blake2b(contents.encode(), digest_size=20).hexdigest()
+
+    def __getitem__(self, key: str) -> object:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                value = self._memory[key]
+            else:
+                loaded = self._load(key)
+                if loaded is None:
+                    self.misses += 1
+                    raise KeyError(key)
+                (value,) = loaded
+                self.disk_hits += 1
+                self._store_memory(key, value)
+        return clone_expression(value)
+
+    def __setitem__(self, key: str, value: object) -> None:
+        try:
+            expression_digest(value)
+        except TypeError:
+            return
+        value = clone_expression(value)
+        with self._lock:
+            self._store_memory(key, value)
+            if self._db is None:
+                return
+            try:
+                data = pickle.dumps(value)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                return
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)",
+                    (key, data),
+                )
+
+    def _store_memory(self, key: str, value: object) -> None:
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def _load(self, key: str) -> typing.Optional[typing.Tuple[object]]:
+        """
+        Returns the value stored on disk in a tuple, or None if there isn't one.
+        """
+        if self._db is None:
+            return None
+        row = self._db.execute(
+            "SELECT value FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        try:
+            return (pickle.loads(row[0]),)
+        except Exception:
+            # The value refers to something that no longer exists
+            return None
+
+    def clear(self) -> None:
+        """
+        Removes all results, from memory and from disk.
+        """
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("DELETE FROM results")
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import threading
+import typing
+
+from metadsl import *
+
+from . import *
+from .testing import Number, from_int
+
+
+_calls: typing.List[typing.Tuple[int, int]] = []
+
+
+@rule
+def _add(a: int, b: int) -> R[Number]:
+    def result() -> Number:
+        _calls.append((a, b))
+        return from_int(a + b)
+
+    return from_int(a) + from_int(b), result
+
+
+def _executor(cache: ResultCache) -> Executor:
+    normalize = StrategyNormalize()
+    normalize.phases["add"].add(_add)
+    return Executor(normalize, cache=cache)
+
+
+class TestResultCache:
+    def test_memory(self):
+        cache = ResultCache()
+        executor = _executor(cache)
+        _calls.clear()
+        assert executor(from_int(1) + from_int(2)) == from_int(3)
+        assert _calls == [(1, 2)]
+        assert cache.misses == 1
+
+        assert executor(from_int(1) + from_int(2)) == from_int(3)
+        assert _calls == [(1, 2)]
+        assert cache.memory_hits == 1
+
+        assert executor(from_int(2) + from_int(2)) == from_int(4)
+        assert _calls == [(1, 2), (2, 2)]
+
+    def test_returns_clones(self):
+        executor = _executor(ResultCache())
+        expr = (from_int(1) + from_int(2)) + from_int(3)
+        assert executor(expr) is not executor(expr)
+
+    def test_evicts_least_recently_used(self):
+        cache = ResultCache(max_size=1)
+        executor = _executor(cache)
+        executor(from_int(1) + from_int(2))
+        executor(from_int(2) + from_int(2))
+        executor(from_int(1) + from_int(2))
+        assert cache.memory_hits == 0
+        assert cache.misses == 3
+
+    def test_disk(self, tmp_path):
+        path = str(tmp_path / "results.db")
+        _executor(ResultCache(path=path))(from_int(1) + from_int(2))
+
+        cache = ResultCache(path=path)
+        _calls.clear()
+        assert _executor(cache)(from_int(1) + from_int(2)) == from_int(3)
+        assert _calls == []
+        assert cache.disk_hits == 1
+
+        cache.clear()
+        assert _executor(cache)(from_int(1) + from_int(2)) == from_int(3)
+        assert _calls == [(1, 2)]
+
+    def test_disk_threads(self, tmp_path):
+        """
+        The database should be usable from other threads than the one that created it
+        """
+        cache = ResultCache(path=str(tmp_path / "results.db"))
+        _executor(cache)(from_int(1) + from_int(2))
+        cache._memory.clear()
+
+        results: typing.List[object] = []
+        thread = threading.Thread(
+            target=lambda: results.append(_executor(cache)(from_int(1) + from_int(2)))
+        )
+        thread.start()
+        thread.join()
+        assert results == [from_int(3)]
+        assert cache.disk_hits == 1
+
+    def test_fingerprint_code(self):
+        """
+        Changing the body of a rule, but not its name, should change the fingerprint
+        """
+
+        def add(a: int, b: int) -> R[Number]:
+            return from_int(a) + from_int(b), lambda: from_int(a + b)
+
+        def add_changed(a: int, b: int) -> R[Number]:
+            return from_int(a) + from_int(b), lambda: from_int(a - b)
+
+        fingerprints = set()
+        for fn in [add, add_changed]:
+            fn.__qualname__ = "_add"
+            assert str(rule(fn)) == str(_add)
+            fingerprints.add(strategy_fingerprint(rule(fn)))
+        assert len(fingerprints) == 2
+        assert strategy_fingerprint(_add) == strategy_fingerprint(_add)
+
+    def test_uncacheable(self):
+        @rule
+        def local_add(a: int, b: int) -> R[Number]:
+            return from_int(a) + from_int(b), lambda: from_int(a + b)
+
+        cache = ResultCache()
+        normalize = StrategyNormalize()
+        normalize.phases["add"].add(local_add)
+        assert cache.key(from_int(1) + from_int(2), normalize) is None
+
+        normalize = StrategyNormalize()
+        normalize.phases["add"].add(_add)
+        assert cache.key(from_int(1) + from_int(2), normalize) is not None
+
+        executor = Executor(normalize, cache=cache)
+        executor(from_int(1) + from_int(2))
+        executor(from_int(1) + from_int(2))
+        assert cache.memory_hits == 1
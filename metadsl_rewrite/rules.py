@@ -9,12 +9,17 @@ Conceptually, this is similar to regular expression matching / finite state tran
 this is a form of symbolic tree transducers, but not implemented in a mathematically consistant way. If it was,
 then we could more easily combine matches to make them execute faster and compute properties about them. This would
 be good to add at a later date, and could be done without having users change their code.
+
+As a first step, the templates are compiled into matchers (see `matchers.py`), instead of being
+walked generically for each node.
 """
 from __future__ import annotations
 
+import contextlib
 import dataclasses
 import functools
 import inspect
+import itertools
 import logging
 import types
 import typing
@@ -23,7 +28,15 @@ import typing_inspect
 
 from metadsl import *
 from metadsl.typing_tools import *
-
+from metadsl.typing_tools import (
+    Infer,
+    get_all_typevars,
+    inspect_signature,
+    typing_get_type_hints,
+)
+
+from .matchers import *
+from .profiling import *
 from .strategies import *
 
 __all__ = ["R", "NoMatch", "rule", "default_rule", "create_wildcard", "datatype_rule"]
@@ -46,6 +59,28 @@ class NoMatch(Exception):
     pass
 
 
+# Used instead of capturing logs when they aren't wanted, which captures no logs
+_NO_LOGS: typing.ContextManager[typing.Sequence[str]] = contextlib.nullcontext(())
+
+
+def _ignore_log(*args: object) -> None:
+    pass
+
+
+def _logging(
+    capture: bool,
+) -> typing.Tuple[
+    typing.ContextManager[typing.Sequence[str]], typing.Callable[..., None]
+]:
+    """
+    Returns the context to capture logs in and the function to log debug messages with,
+    which do nothing if logs aren't captured.
+    """
+    if capture:
+        return CaptureLogging(), logger.debug
+    return _NO_LOGS, _ignore_log
+
+
 def rule(fn: MatchFunctionType) -> Strategy:
     """
     Creates a new strategy given a callable that accepts wildcards and returns
@@ -170,16 +205,95 @@ class DefaultRule(Strategy):
     inner_fn: typing.Callable = dataclasses.field(
         init=False, repr=False, compare=False, hash=False
     )
+    # The head keys of the nodes this can match, which are the calls of the function
+    heads: typing.FrozenSet[typing.Hashable] = dataclasses.field(
+        init=False, repr=False, compare=False, hash=False
+    )
+    # The wildcards for the args and the result of calling the body with them, created by
+    # `optimize` if the body can be called with wildcards
+    template: typing.Optional[
+        typing.Tuple[typing.List[Expression], object]
+    ] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False, hash=False
+    )
+    optimized: bool = dataclasses.field(
+        default=False, init=False, repr=False, compare=False, hash=False
+    )
 
     def __str__(self):
         return f"{self.inner_fn.__module__}.{self.inner_fn.__qualname__}"
 
     def __post_init__(self):
         self.inner_fn = self.fn.__wrapped__  # type: ignore
+        fn = self.fn
+        self.heads = frozenset(
+            [fn.fn if isinstance(fn, (Infer, BoundInfer)) else fn]  # type: ignore
+        )
 
     def optimize(self, executor, strategy):
-        # TODO: Implement optimizations for default rules
-        pass
+        """
+        Calls the body once with wildcards, so that each time the rule matches, the args only
+        have to be substituted into the result, instead of calling the body again.
+        """
+        if self.optimized:
+            return
+        self.optimized = True
+        self.template = self._create_template()
+
+    def _create_template(
+        self,
+    ) -> typing.Optional[typing.Tuple[typing.List[Expression], object]]:
+        """
+        Returns the wildcards and the body called with them, or None if the result could
+        depend on the values of the args.
+
+        This is only the case if all the args are expressions, since the body could branch on
+        the values of other args, and if calling the body twice gives equal results, since it
+        could create new objects, like variables, on each call.
+        """
+        fn = self.fn
+        parameters = list(inspect_signature(self.inner_fn).parameters.values())
+        if any(
+            parameter.kind != inspect.Parameter.POSITIONAL_OR_KEYWORD
+            for parameter in parameters
+        ):
+            return None
+        hints = typing_get_type_hints(self.inner_fn)
+        owner_args: typing.List[object] = []
+        arg_types: typing.List[typing.Type] = []
+        if isinstance(fn, BoundInfer):
+            owner = get_origin_type(fn.owner)
+            self_parameter, *parameters = parameters
+            if fn.is_classmethod:
+                owner_args.append(owner)
+            else:
+                arg_types.append(owner)
+        try:
+            arg_types.extend(hints[parameter.name] for parameter in parameters)
+            if not all(
+                issubclass(typing_inspect.get_origin(tp) or tp, Expression)
+                for tp in arg_types
+            ):
+                return None
+        except (KeyError, TypeError):
+            return None
+        wildcards = [create_wildcard(tp) for tp in arg_types]
+        typevars = {
+            typevar
+            for tp in [*owner_args, *arg_types]
+            for typevar in get_all_typevars(tp)  # type: ignore
+        }
+        try:
+            with TypeVarScope(*typevars):
+                results = [
+                    self.inner_fn(*owner_args, *wildcards),
+                    self.inner_fn(*owner_args, *wildcards),
+                ]
+        except Exception:
+            return None
+        if results[0] != results[1]:
+            return None
+        return wildcards, results[0]
 
     def __call__(self, ref: ExpressionReference) -> typing.Iterable[Result]:
         """
@@ -189,10 +303,21 @@ class DefaultRule(Strategy):
         and apply it to the return value. This is so that if the body uses generic type
         variables, they are turned into the actual instantiations.
         """
-        with CaptureLogging() as results:
+        return profile_rule(self, ref, self._replace)
+
+    def _replace(
+        self, ref: ExpressionReference, timer: typing.Optional[RuleTimer]
+    ) -> typing.Iterable[Result]:
+        misses = MissCache.of(ref)
+        hash_ = ref.hash
+        if misses.contains(self, hash_):
+            return
+        capture_logs, debug = _logging(logs_enabled())
+        with capture_logs as results:
             expr = ref.expression
-            logger.debug("DefaultRule.__call__ self=%s expr=%s", self, expr)
+            debug("DefaultRule.__call__ self=%s expr=%s", self, expr)
             if not isinstance(expr, Expression):
+                misses.add(self, hash_)
                 return
 
             fn = self.fn
@@ -202,8 +327,9 @@ class DefaultRule(Strategy):
             # If any of the args are placeholders, don't match!
             if any(
                 isinstance(arg, PlaceholderExpression)
-                for arg in args + list(expr.kwargs.values())
+                for arg in itertools.chain(args, expr.kwargs.values())
             ):
+                misses.add(self, hash_)
                 return None
 
             typevars: TypeVarMapping = infer_return_type(
@@ -215,18 +341,37 @@ class DefaultRule(Strategy):
             )[-1]
             if isinstance(fn, BoundInfer) and isinstance(expr.function, BoundInfer):
                 if fn.fn != expr.function.fn:
+                    misses.add(self, hash_)
                     return None
                 if fn.is_classmethod:
                     args = [
                         typing.cast(object, replace_typevars(typevars, fn.owner))
-                    ] + args
+                    ] + list(args)
 
             elif fn != expr.function:
+                misses.add(self, hash_)
                 return None
+            if timer:
+                timer.build()
+            template = self.template
             with TypeVarScope(*typevars.keys()):
-                new_expr = self.inner_fn(*args, **expr.kwargs)
+                if (
+                    template is not None
+                    and not expr.kwargs
+                    and len(expr.args) == len(template[0])
+                ):
+                    new_expr = ReplaceValues(
+                        UnhashableMapping(
+                            *(
+                                Item(wildcard, arg)
+                                for wildcard, arg in zip(template[0], expr.args)
+                            )
+                        )
+                    )(template[1])
+                else:
+                    new_expr = self.inner_fn(*args, **expr.kwargs)
                 result = ReplaceTypevarsExpression(typevars)(new_expr)
-            logger.debug("DefaultRule.__call__ result=%s", result)
+            debug("DefaultRule.__call__ result=%s", result)
 
             ref.replace(result)
         yield Result(str(self), logs="\n".join(results))
@@ -272,21 +417,31 @@ class Rule(Strategy):
 
     matchfunction: MatchFunctionType
 
-    # the wildcards that are present in the template
-    wildcards: typing.List[Expression] = dataclasses.field(
-        init=False, hash=False, compare=False
+    optimized: bool = dataclasses.field(
+        default=False, init=False, hash=False, compare=False, repr=False
     )
 
-    results: typing.List[R] = dataclasses.field(init=False, hash=False, compare=False)
-
     def __str__(self):
         return f"{self.matchfunction.__module__}.{self.matchfunction.__qualname__}"
 
     def __post_init__(self):
         functools.update_wrapper(self, self.matchfunction)
-        # Create one wildcard` per argument
-        self.wildcards = [create_wildcard(a) for a in get_arg_hints(self.matchfunction)]
 
+    # The templates are built the first time they are used, instead of when the rule is defined,
+    # so that defining rules, which mostly happens when importing, doesn't call the functions
+
+    @functools.cached_property
+    def wildcards(self) -> typing.List[Expression]:
+        """
+        The wildcards that are present in the template, one per argument.
+        """
+        return [create_wildcard(a) for a in get_arg_hints(self.matchfunction)]
+
+    @functools.cached_property
+    def results(self) -> typing.List[R]:
+        """
+        The templates and replacements returned by calling the function with the wildcards.
+        """
         # we match the wildcards against themselves to get an identity typevar mapping
         # TODO: Replace with just grabbing all typevars from arg types themselves
         typevars_in_args = match_values(
@@ -296,37 +451,136 @@ class Rule(Strategy):
         with TypeVarScope(*typevars_in_args):
             # Call the function first to create a template with the wildcards
             result = self.matchfunction(*self.wildcards)
-            self.results = (
+            return (
                 list(result)  # type: ignore
                 if inspect.isgeneratorfunction(self.matchfunction)
                 else [result]
             )
 
+    @functools.cached_property
+    def heads(self) -> typing.Optional[typing.FrozenSet[typing.Hashable]]:
+        """
+        The head keys of the templates, or None if any of them is a wildcard, so it can match any node.
+        """
+        templates = [template for template, _ in self.results]
+        if any(template in self.wildcards for template in templates):
+            return None
+        try:
+            return frozenset(map(head_key, templates))
+        except TypeError:
+            # One of the functions is unhashable
+            return None
+
+    @functools.cached_property
+    def automaton(self) -> typing.Optional[MatcherAutomaton]:
+        """
+        The templates compiled into one automaton, or None if one of them couldn't be compiled,
+        in which case they are matched with `match_expression`.
+        """
+        try:
+            return MatcherAutomaton(
+                [
+                    compile_template(self.wildcards, template)
+                    for template, _ in self.results
+                ]
+            )
+        except CannotCompile:
+            return None
+
     def optimize(self, executor: Executor, strategy: Strategy) -> None:
+        """
+        Executes the results that don't depend on the wildcards ahead of time.
 
+        Thunks that don't close over any variables, so only use globals, are called once,
+        instead of each time they match. Results that contain wildcards are left as they are,
+        since executing them could match the wildcards with any rule and never finish.
+        """
+        if self.optimized:
+            return
+        self.optimized = True
         for i, result in enumerate(self.results):
             template, expression_thunk = result
-            # apply execution to all results that are not thunks
-            if not isinstance(expression_thunk, types.FunctionType):
-                self.results[i] = (template, executor(expression_thunk, strategy))
-
-    def __call__(self, ref: ExpressionReference) -> typing.Iterable[Result]:
-        expr = ref.expression
-        with CaptureLogging() as logs:
-            logger.debug("Rule.__call__ self=%s expr=%s", self, expr)
-            for i, result in enumerate(self.results):
-                template, expression_thunk = result
+            if isinstance(expression_thunk, types.FunctionType):
+                if expression_thunk.__code__.co_freevars:
+                    continue
                 try:
-                    logger.debug("Trying to match against %s", template)
-                    typevars, wildcards_to_nodes = match_expression(  # type: ignore
-                        self.wildcards, template, expr
-                    )
+                    expression_thunk = expression_thunk()
                 except NoMatch:
-                    logger.debug("Not a match")
                     continue
-                logger.debug(
-                    "Matched expr=%s typevars=%s", wildcards_to_nodes, typevars
+            if _contains_any(expression_thunk, self.wildcards):
+                continue
+            self.results[i] = (template, executor(expression_thunk, strategy))
+
+    def _matches(
+        self, expr: object, candidates: typing.Optional[typing.List[int]] = None
+    ) -> typing.Iterator[typing.Tuple[int, TypeVarMapping, WildcardMapping]]:
+        """
+        Yields the index, typevars and mapping of wildcards to nodes for each template that matches.
+
+        If the candidates of the automaton are passed in, only those templates are tried.
+        """
+        automaton = self.automaton
+        if automaton is not None:
+            if candidates is None:
+                candidates = automaton.candidates(expr)
+            for i in candidates:
+                matcher = automaton.matchers[i]
+                res = matcher.match(expr)
+                if res is None:
+                    continue
+                typevars, bound = res
+                yield i, typevars, UnhashableMapping(
+                    *(Item(self.wildcards[slot], bound[slot]) for slot in matcher.slots)
+                )
+            return
+        _, debug = _logging(logs_enabled())
+        for i, (template, _) in enumerate(self.results):
+            try:
+                debug("Trying to match against %s", template)
+                typevars, wildcards_to_nodes = match_expression(
+                    self.wildcards, template, expr
                 )
+            except NoMatch:
+                debug("Not a match")
+                continue
+            yield i, typevars, wildcards_to_nodes
+
+    def __call__(self, ref: ExpressionReference) -> typing.Iterable[Result]:
+        return profile_rule(self, ref, self._replace)
+
+    def replace_candidates(
+        self, ref: ExpressionReference, candidates: typing.List[int]
+    ) -> typing.Iterable[Result]:
+        """
+        Calls the rule, only trying the templates at the candidates of its automaton, which were
+        already found by an automaton that it was merged into.
+        """
+        return profile_rule(
+            self, ref, functools.partial(self._replace, candidates=candidates)
+        )
+
+    def _replace(
+        self,
+        ref: ExpressionReference,
+        timer: typing.Optional[RuleTimer],
+        candidates: typing.Optional[typing.List[int]] = None,
+    ) -> typing.Iterable[Result]:
+        misses = MissCache.of(ref)
+        hash_ = ref.hash
+        if misses.contains(self, hash_):
+            return
+        expr = ref.expression
+        # Whether not matching only depends on the node, and so can be cached. Replacement
+        # functions can raise NoMatch based on other state, so those misses aren't cached.
+        cacheable = True
+        capture_logs, debug = _logging(logs_enabled())
+        with capture_logs as logs:
+            debug("Rule.__call__ self=%s expr=%s", self, expr)
+            for i, typevars, wildcards_to_nodes in self._matches(expr, candidates):
+                if timer:
+                    timer.build()
+                _, expression_thunk = self.results[i]
+                debug("Matched expr=%s typevars=%s", wildcards_to_nodes, typevars)
                 # if the result is a function, we can't use substitution, so instead we re-call
                 # with args and use that result
                 if isinstance(expression_thunk, types.FunctionType):
@@ -352,12 +606,13 @@ class Rule(Strategy):
                         try:
                             result_expr: object = expression_thunk()
                         except NoMatch:
+                            cacheable = False
                             continue
                 else:
                     result_expr = ReplaceValues(wildcards_to_nodes)(expression_thunk)
                 with TypeVarScope(*typevars.keys()):
                     result_expr = ReplaceTypevarsExpression(typevars)(result_expr)
-                logger.debug("Rule.__call__ res=%s", result_expr)
+                debug("Rule.__call__ res=%s", result_expr)
                 ref.replace(result_expr)
                 yield Result(
                     # if there is more than one possible match from this strategy, also put the index of the match
@@ -365,6 +620,29 @@ class Rule(Strategy):
                     logs="\n".join(logs),
                 )
                 return
+        if cacheable:
+            misses.add(self, hash_)
+        else:
+            misses.uncacheable += 1
+
+
+def _contains_any(expr: object, values: typing.Sequence[object]) -> bool:
+    """
+    Returns whether any of the values is in the expression.
+    """
+    found = False
+
+    def shortcut(value: object) -> object:
+        nonlocal found
+        if found or any(
+            value is v or (isinstance(value, Expression) and value == v) for v in values
+        ):
+            found = True
+            return value
+        return NotImplemented
+
+    map_expression(expr, lambda expr, args, kwargs: expr, shortcut)
+    return found
 
 
 @dataclasses.dataclass
@@ -372,16 +650,18 @@ class ReplaceValues:
     mapping: typing.Mapping
 
     def __call__(self, expr):
-        if expr in self.mapping:
-            return self.mapping[expr]
-        if not isinstance(expr, Expression):
-            return expr
-        result = expr._map(self)
+        return map_expression(expr, self._replace_node, self._lookup)
 
+    def _lookup(self, value):
+        if value in self.mapping:
+            return self.mapping[value]
+        return NotImplemented
+
+    def _replace_node(self, expr, args, kwargs):
         # if any of the args are create_iterated_placeholder
         # then remove those and replaced with arg expanded.
         new_args: typing.List = []
-        for arg in result.args:
+        for arg in args:
             if (
                 isinstance(arg, Expression)
                 and arg.function == create_iterated_placeholder
@@ -392,8 +672,7 @@ class ReplaceValues:
                     new_args.append(inner_arg)
             else:
                 new_args.append(arg)
-        result.args = new_args
-        return result
+        return expr._with_children(new_args, kwargs)
 
 
 @dataclasses.dataclass(frozen=True)
@@ -411,17 +690,29 @@ class ReplaceTypevarsExpression:
         """
         Replaces all typevars found in the classmethods of an expression.
         """
-        typevars = self.typevars
-        if isinstance(expression, Expression):
-            return expression._map(
-                fn=self,
-                function_fn=lambda fn: replace_fn_typevars(fn, typevars),  # type: ignore
-                type_fn=lambda tp: replace_typevars(typevars, tp),
-            )
+        if not self.typevars:
+            return expression
+        return map_expression(expression, self._replace_node, self._replace_value)
+
+    def _replace_node(self, expr, args, kwargs):
+        new_expr = expr._with_children(
+            args, kwargs, function=replace_fn_typevars(expr.function, self.typevars)
+        )
+        if expr._type is not type(expr):
+            new_expr._type = replace_typevars(self.typevars, expr._type)
+        return new_expr
+
+    def _replace_value(self, value: object) -> object:
+        if isinstance(value, Expression):
+            # Reuse the parts that can't change as they are, instead of rebuilding them.
+            # Mutable ones are still copied, since the graph could mutate them in place.
+            if value._frozen_without_typevars():
+                return value
+            return NotImplemented
         return replace_fn_typevars(
-            expression,
-            typevars,
-            ReplaceTypevarsExpression(typevars=HashableMapping(typevars)),
+            value,
+            self.typevars,
+            ReplaceTypevarsExpression(typevars=HashableMapping(self.typevars)),
         )
 
 
@@ -429,7 +720,7 @@ def wildcard_inner_type(wildcard: object) -> typing.Type:
     """
     Return inner type for a wildcard
     """
-    return typing_inspect.get_args(typing_inspect.get_generic_type(wildcard))[0]
+    return typing_inspect.get_args(typing.cast(Expression, wildcard)._type)[0]
 
 
 def is_vague_type(t: typing.Type) -> bool:
@@ -450,29 +741,28 @@ def match_expression(
 
     A wildcard can match either an expression or a value. If it matches two nodes, they must be equal.
     """
-    logger.debug(
+    _, debug = _logging(logs_enabled())
+    debug(
         "match_expression wildcards=%s template=%s expr=%s", wildcards, template, expr
     )
     if template in wildcards:
-        logger.debug(
-            "template is a wildcard, matching expr to template to get typevars"
-        )
+        debug("template is a wildcard, matching expr to template to get typevars")
         # Match type of wildcard with type of expression
         try:
             res = (
                 match_values(template, expr),
                 UnhashableMapping(Item(typing.cast(Expression, template), expr)),
             )
-            logger.debug("got wildcard mapping %s", res)
+            debug("got wildcard mapping %s", res)
             return res
         except TypeError:
-            logger.debug("could not match types")
+            debug("could not match types")
             raise NoMatch
 
     if isinstance(expr, Expression):
-        logger.debug("value is expression")
+        debug("value is expression")
         if not isinstance(template, Expression):
-            logger.debug("...but template isn't so no match")
+            debug("...but template isn't so no match")
             raise NoMatch
         # Any typevars in the template that are unbound should be matched with their
         # versions in the expr
@@ -482,11 +772,11 @@ def match_expression(
                 template.function, expr.function
             )
         except TypeError:
-            logger.debug("could not match functions")
+            debug("could not match functions")
             raise NoMatch
-        logger.debug("matched functions to get typevar_apping=%s", fn_type_mapping)
+        debug("matched functions to get typevar_apping=%s", fn_type_mapping)
         if set(expr.kwargs.keys()) != set(template.kwargs.keys()):
-            logger.debug("No match because typevars not same keys")
+            debug("No match because typevars not same keys")
             raise TypeError("Wrong kwargs in match")
 
         template_args: typing.Iterable[object]
@@ -543,7 +833,7 @@ def match_expression(
                 ),
             )
         ) or ((), ())
-        logger.debug("Matched args and kwargs")
+        debug("Matched args and kwargs")
         try:
             merged_typevars: TypeVarMapping = merge_typevars(
                 fn_type_mapping, *type_mappings
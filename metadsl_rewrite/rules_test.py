@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import logging
+import threading
 import typing
 
 import pytest
@@ -8,6 +10,8 @@ from metadsl import *
 from metadsl.typing_tools import *
 
 from . import *
+from . import rules
+from .testing import CallStrategy, from_int
 
 
 class _SomeExpression(Expression):
@@ -93,6 +97,48 @@ class TestRule:
         expr = _from_int(1) + _from_int(2)
         assert execute(expr, _add_rule) == _from_int(3)
 
+    def test_heads(self):
+        assert _add_rule.heads == {_Number.__add__.fn}
+
+        @rule
+        def _any(x: _Number) -> R[_Number]:
+            return x, x
+
+        assert _any.heads is None
+
+    def test_miss_cache(self):
+        ref = ExpressionReference.from_expression(_from_int(1) + _Number.NaN())
+        misses = MissCache.of(ref)
+        assert not list(_add_rule(ref))
+        assert misses.contains(_add_rule, ref.hash)
+        assert not list(_add_rule(ref))
+        assert misses.stats == MissCacheStats(hits=2, lookups=3)
+
+        # The cache is per graph
+        other_ref = ExpressionReference.from_expression(_from_int(1) + _Number.NaN())
+        assert not MissCache.of(other_ref).contains(_add_rule, other_ref.hash)
+
+    def test_miss_cache_no_match(self):
+        """
+        If the replacement raises NoMatch, it might match later, so it shouldn't be cached
+        """
+        matches = [False]
+
+        def replacement():
+            if not matches[0]:
+                raise NoMatch
+            return _Number.NaN()
+
+        @rule
+        def _maybe(a: int) -> R[_Number]:
+            return _from_int(a), replacement
+
+        ref = ExpressionReference.from_expression(_from_int(1))
+        assert not list(_maybe(ref))
+        matches[0] = True
+        assert list(_maybe(ref))
+        assert ref.expression == _Number.NaN()
+
     def test_type_args(self):
         @rule
         def _concat_lists(l: T, r: T) -> R[_List[T]]:
@@ -233,6 +279,95 @@ class TestRule:
         expr = s + _from_int(0)
         assert execute(expr, _add_zero_rule) == s
 
+    def test_logs(self, monkeypatch):
+        results: typing.List[Result] = []
+
+        def collect(ref: ExpressionReference, strategy: Strategy) -> object:
+            results.extend(strategy(ref))
+            return ref.expression
+
+        expr = _from_int(1) + _from_int(2)
+        rules.logger.setLevel(logging.DEBUG)
+        try:
+            assert Executor(_add_rule, collect)(expr) == _from_int(3)
+            assert "Rule.__call__" in results[-1].logs
+
+            # Without logs, they should not be captured at all
+            monkeypatch.setattr(rules, "CaptureLogging", None)
+            assert Executor(_add_rule, collect, logs=False)(expr) == _from_int(3)
+            assert results[-1].logs == ""
+
+            # Nor logged when matching the templates without an automaton
+            generic = rules.Rule(_add_rule.matchfunction)
+            monkeypatch.setattr(generic, "automaton", None)
+            monkeypatch.setattr(rules.logger, "debug", None)
+            assert Executor(generic, collect, logs=False)(expr) == _from_int(3)
+        finally:
+            rules.logger.setLevel(logging.NOTSET)
+        assert logs_enabled()
+
+    def test_logs_threads(self):
+        """
+        Executors in different threads should not turn off each others logs
+        """
+        paused, resume = threading.Event(), threading.Event()
+        seen: typing.List[bool] = []
+
+        def pause():
+            paused.set()
+            resume.wait(10)
+            seen.append(logs_enabled())
+
+        thread = threading.Thread(
+            target=Executor(CallStrategy(pause)), args=(from_int(1),)
+        )
+        thread.start()
+        paused.wait(10)
+
+        def run_other():
+            resume.set()
+            thread.join(10)
+
+        Executor(CallStrategy(run_other), logs=False)(from_int(1))
+        assert seen == [True]
+
+    def test_lazy(self):
+        """
+        The function is only called once the templates are used, instead of when the rule is defined
+        """
+        calls = []
+
+        @rule
+        def add_zero(a: _Number) -> R[_Number]:
+            calls.append(a)
+            return a + _from_int(0), a
+
+        assert calls == []
+        assert execute(_from_int(1) + _from_int(0), add_zero) == _from_int(1)
+        assert len(calls) == 1
+
+    def test_optimize(self):
+        @rule
+        def _nan_add(a: _Number) -> R[_Number]:
+            return _Number.NaN() + a, _Number.NaN()
+
+        @rule
+        def _add_nan(a: _Number) -> R[_Number]:
+            return a + _Number.NaN(), lambda: _Number.NaN() + _Number.NaN()
+
+        @rule
+        def _add_zero(a: _Number) -> R[_Number]:
+            return a + _from_int(0), a
+
+        executor = Executor(StrategyRepeat(StrategyFold(_nan_add)))
+        _add_nan.optimize(executor, executor.default_strategy)
+        assert _add_nan.results[0][1] == _Number.NaN()
+        assert execute(_from_int(1) + _Number.NaN(), _add_nan) == _Number.NaN()
+
+        # Results that contain wildcards are not executed
+        _add_zero.optimize(executor, executor.default_strategy)
+        assert _add_zero.results[0][1] in _add_zero.wildcards
+
     def test_generator_rule(self):
         @expression
         def _from_str(s: str) -> _Number:
@@ -345,6 +480,21 @@ class TestRule:
         )
 
 
+# The expressions that `_Doubled.double` was called with
+_double_calls: typing.List[_Doubled] = []
+
+
+class _Doubled(Expression):
+    @expression
+    def __add__(self, other: _Doubled) -> _Doubled:
+        ...
+
+    @expression
+    def double(self) -> _Doubled:
+        _double_calls.append(self)
+        return self + self
+
+
 class TestDefaultRule:
     def test_fn(self):
         @expression
@@ -357,6 +507,7 @@ class TestDefaultRule:
 
         assert fn(10) != inner_fn(10)
         assert execute(fn(10), default_rule(fn)) == inner_fn(10)
+        assert default_rule(fn).heads == {fn.fn}
 
     def test_method(self):
         class C(Expression):
@@ -378,6 +529,33 @@ class TestDefaultRule:
         assert create().double() != create() + create()
         assert execute(create().double(), rule) == create() + create()
 
+    def test_optimize(self):
+        @expression
+        def create(i: int) -> _Doubled:
+            ...
+
+        rule = default_rule(_Doubled.double)
+        rule.optimize(execute, rule)
+        assert rule.template is not None
+        n_calls = len(_double_calls)
+        assert execute(create(1).double(), rule) == create(1) + create(1)
+        assert execute(create(2).double(), rule) == create(2) + create(2)
+        assert len(_double_calls) == n_calls
+
+    def test_optimize_value_args(self):
+        """
+        The body should not be called with wildcards for args that aren't expressions
+        """
+
+        @expression
+        def fn(a: int) -> _Number:
+            return _from_int(a + 1) if isinstance(a, int) else _from_int(0)
+
+        rule = default_rule(fn)
+        rule.optimize(execute, rule)
+        assert rule.template is None
+        assert execute(fn(1), rule) == _from_int(2)
+
     def test_method_generic(self):
         class C(Expression, typing.Generic[T]):
             @expression
@@ -570,3 +748,30 @@ class TestDatatypeRule:
         assert execute(expr.update(i=2, b="b"), datatypes_rule_) == _Datatype.create(
             2, "b"
         )
+
+
+class TestReplaceTypevarsExpression:
+    def test_reuses_frozen(self):
+        toggle_immutable_expressions(True)
+        try:
+            number = _from_int(1) + _from_int(2)
+            expr = _List[T].create(number, number)
+        finally:
+            toggle_immutable_expressions(False)
+        result = rules.ReplaceTypevarsExpression({T: _Number})(expr)
+        assert get_type(result) == _List[_Number]
+        assert result.args[0] is number
+
+        # The typevars in the type of the result are replaced, so it can't be reused
+        assert not expr._frozen_without_typevars()
+        assert number._frozen_without_typevars()
+
+    def test_copies_mutable(self):
+        number = _from_int(1) + _from_int(2)
+        result = rules.ReplaceTypevarsExpression({T: _Number})(_List[T].create(number))
+        assert result == _List[_Number].create(number)
+        assert result.args[0] is not number
+
+    def test_no_typevars(self):
+        number = _from_int(1) + _from_int(2)
+        assert rules.ReplaceTypevarsExpression({})(number) is number
@@ -8,12 +8,29 @@ and this paper
 """
 from __future__ import annotations
 
+import contextvars
 import dataclasses
 import typing
+import weakref
 
 from metadsl import *
+from metadsl.typing_tools import BoundInfer, Infer
 
-__all__ = ["Strategy", "Executor", "Result"]
+from .profiling import *
+
+if typing.TYPE_CHECKING:
+    from .result_cache import ResultCache
+
+__all__ = [
+    "Strategy",
+    "Executor",
+    "Result",
+    "head_key",
+    "MissCache",
+    "MissCacheStats",
+    "miss_cache_stats",
+    "logs_enabled",
+]
 
 T = typing.TypeVar("T")
 
@@ -35,6 +52,13 @@ class Executor:
     execute: typing.Callable[
         [ExpressionReference, Strategy], object
     ] = dataclasses.field(default=_execute_all)
+    # Optional cache of results, kept between calls
+    cache: typing.Optional[ResultCache] = None
+    # Whether strategies should capture their logs in their results. If no one reads them,
+    # turning this off saves capturing them on every call of every rule.
+    logs: bool = True
+    # Optional profile, which rules record what they did to while executing
+    profile: typing.Optional[Profile] = None
 
     def __call__(self, expr: T, strategy: typing.Optional[Strategy] = None) -> T:
         execute: typing.Callable[  # type: ignore
@@ -43,17 +67,44 @@ class Executor:
         default_strategy: Strategy = self.default_strategy  # type: ignore
         strategy = strategy or default_strategy
         assert strategy
-        return typing.cast(
-            T,
-            execute(
-                ExpressionReference.from_expression(clone_expression(expr)), strategy
-            ),
-        )
+        cache = self.cache
+        key = cache.key(expr, strategy) if cache is not None else None
+        if key is not None:
+            try:
+                return typing.cast(T, cache[key])  # type: ignore
+            except KeyError:
+                pass
+        logs_token = _logs_enabled.set(self.logs)
+        try:
+            with profiling(self.profile):
+                result = execute(
+                    ExpressionReference.from_expression(clone_expression(expr)),
+                    strategy,
+                )
+        finally:
+            _logs_enabled.reset(logs_token)
+        if key is not None:
+            cache[key] = result  # type: ignore
+        return typing.cast(T, result)
 
     def optimize(self) -> None:
         self.default_strategy.optimize(self, NoOpStrategy())
 
 
+# Whether the executor that is running in this context wants logs
+_logs_enabled: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "logs_enabled", default=True
+)
+
+
+def logs_enabled() -> bool:
+    """
+    Returns whether strategies should capture their logs in their results, which is false if
+    they are being executed by an executor that doesn't want them.
+    """
+    return _logs_enabled.get()
+
+
 @dataclasses.dataclass
 class Result:
     # The name of the strategy that was executed
@@ -64,6 +115,111 @@ class Result:
     label: typing.Optional[str] = None
 
 
+# Head key of all values that are not expressions
+_LEAF = object()
+
+
+def head_key(value: object) -> typing.Hashable:
+    """
+    Returns the key of a node that strategies are indexed by.
+
+    For an expression, this is its function, without the type it is bound to. All values
+    that aren't expressions share one key.
+
+    Strategies can have a `heads` attribute, with the set of keys of the nodes they can match,
+    or None if they can match any node. Strategies without it are assumed to match any node.
+    """
+    if not isinstance(value, Expression):
+        return _LEAF
+    fn = value.function
+    if isinstance(fn, (Infer, BoundInfer)):
+        return fn.fn
+    return fn
+
+
+@dataclasses.dataclass
+class MissCacheStats:
+    """
+    Counts how often a miss cache was checked, and how often it knew the strategy wouldn't match.
+    """
+
+    hits: int = 0
+    lookups: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def reset(self) -> None:
+        self.hits = 0
+        self.lookups = 0
+
+
+# Stats of the miss caches of all graphs
+miss_cache_stats = MissCacheStats()
+
+
+@dataclasses.dataclass
+class MissCache:
+    """
+    Records which strategies didn't match which nodes, by the hash of the node.
+
+    Since the hash of a node is based on its contents, a strategy that didn't match a node
+    won't match any node with the same hash. There is one cache per graph, so they only last
+    as long as one execution. Once it is full, the oldest misses are dropped first.
+
+    Misses that depend on more than the node can't be recorded, so they are only counted.
+    """
+
+    max_size: int = 2**16
+    _misses: typing.Dict[typing.Tuple[Strategy, Hash], None] = dataclasses.field(
+        default_factory=dict, repr=False
+    )
+    stats: MissCacheStats = dataclasses.field(default_factory=MissCacheStats)
+    # Number of misses that depended on other state, so might match later
+    uncacheable: int = 0
+
+    _caches: typing.ClassVar[weakref.WeakKeyDictionary] = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def of(cls, ref: ExpressionReference) -> MissCache:
+        """
+        Returns the cache for the graph of the reference.
+        """
+        graph = ref._graph
+        cache = cls._caches.get(graph)
+        if cache is None:
+            cache = cls._caches[graph] = cls()
+        return cache
+
+    def contains(self, strategy: Strategy, hash_: Hash) -> bool:
+        """
+        Returns whether the strategy is known to not match nodes with this hash.
+        """
+        try:
+            hit = (strategy, hash_) in self._misses
+        except TypeError:
+            # The strategy is unhashable
+            return False
+        for stats in (self.stats, miss_cache_stats):
+            stats.lookups += 1
+            stats.hits += hit
+        return hit
+
+    def add(self, strategy: Strategy, hash_: Hash) -> None:
+        """
+        Records that the strategy doesn't match nodes with this hash.
+        """
+        try:
+            key = (strategy, hash_)
+            hash(key)
+        except TypeError:
+            return
+        if len(self._misses) >= self.max_size:
+            del self._misses[next(iter(self._misses))]
+        self._misses[key] = None
+
+
 class Strategy(typing.Protocol):
     def __call__(self, ref: ExpressionReference) -> typing.Iterable[Result]:
         ...
@@ -0,0 +1,55 @@
+"""
+Expressions, rules and strategies shared by the tests of the executors.
+"""
+from __future__ import annotations
+
+import dataclasses
+import typing
+
+from metadsl import *
+
+from .rules import *
+from .strategies import *
+
+__all__ = ["Number", "from_int", "add_rule", "double_rule", "CallStrategy"]
+
+
+class Number(Expression):
+    @expression
+    def __add__(self, other: Number) -> Number:
+        ...
+
+    @expression
+    def double(self) -> Number:
+        ...
+
+
+@expression
+def from_int(i: int) -> Number:
+    ...
+
+
+@rule
+def add_rule(a: int, b: int) -> R[Number]:
+    return from_int(a) + from_int(b), lambda: from_int(a + b)
+
+
+@rule
+def double_rule(a: Number) -> R[Number]:
+    return a.double(), a + a
+
+
+@dataclasses.dataclass
+class CallStrategy(Strategy):
+    """
+    Calls a function whenever it is called, without ever matching.
+    """
+
+    fn: typing.Callable[[], object]
+
+    def __call__(self, ref: ExpressionReference) -> typing.Iterable[Result]:
+        self.fn()
+        return ()
+
+    def optimize(self, executor, strategy):
+        pass
@@ -0,0 +1,187 @@
+"""
+An engine for executing a `StrategyNormalize` with worklists of nodes, instead of folding over
+the whole graph after each replacement.
+
+Whether a node matches a strategy mostly only depends on its descendents. So once a node has
+been checked against a set of strategies without matching, it only has to be checked again once
+it, or one of its descendents, changes. After each replacement the graph reports the nodes that
+were added or changed, which are pushed onto the worklists, so the work done per replacement
+tracks the size of the change instead of the size of the graph. Nodes that didn't match because
+of other state, which are counted as uncacheable misses in the `MissCache`, are checked again
+after every replacement.
+"""
+from __future__ import annotations
+
+import collections
+import dataclasses
+import typing
+
+from metadsl import *
+from metadsl.normalized import Graph
+
+from .combinators import *
+from .normalize import *
+from .profiling import *
+from .strategies import *
+
+__all__ = ["StrategyWorklist", "execute_worklist"]
+
+
+class _Worklist:
+    """
+    Queue of nodes that have to be checked, without duplicates.
+    """
+
+    def __init__(self, nodes: typing.Iterable[int] = ()):
+        self._queue: typing.Deque[int] = collections.deque()
+        self._pending: typing.Set[int] = set()
+        # Nodes to check again after the next replacement
+        self._deferred: typing.List[int] = []
+        self.extend(nodes)
+
+    def extend(self, nodes: typing.Iterable[int]) -> None:
+        for node in nodes:
+            if node not in self._pending:
+                self._pending.add(node)
+                self._queue.append(node)
+
+    def defer(self, node: int) -> None:
+        self._deferred.append(node)
+
+    def retry(self) -> None:
+        """
+        Adds back the deferred nodes.
+        """
+        self.extend(self._deferred)
+        self._deferred.clear()
+
+    def pop(self, graph: Graph) -> typing.Optional[int]:
+        """
+        Returns the next node that still exists in the graph, or None if there are none left.
+        """
+        while self._queue:
+            node = self._queue.popleft()
+            self._pending.discard(node)
+            if node < len(graph._orders) and graph._orders[node] >= 0:
+                return node
+        return None
+
+
+@dataclasses.dataclass
+class StrategyWorklist(Strategy):
+    """
+    Executes a `StrategyNormalize`, with the same phases and labels, using worklists.
+
+    Each phase is run until none of its strategies match, like `StrategyRepeat(StrategyFold(...))`,
+    but a node is only checked again after it changes. The strategies in `pre` are still
+    applied before those of the phase, whenever both match.
+    """
+
+    normalize: StrategyNormalize
+    # Maximum number of replacements in one phase, and of passes through all of them
+    max_calls: int = 1000
+
+    def __call__(self, expr: ExpressionReference) -> typing.Iterable[Result]:
+        normalize = self.normalize
+        pre = normalize.pre_strategy
+        for _ in range(self.max_calls):
+            graph = expr._graph
+            replaced = False
+
+            for result in self._run(
+                expr, [pre], [_Worklist(graph._topological_order())]
+            ):
+                replaced = True
+                yield result
+
+            current_strategies: typing.Set[Strategy] = set()
+            for label, strategies in normalize.phases.items():
+                current_strategies.update(strategies)
+                # The pre strategies already don't match anywhere, so only the nodes that change
+                # have to be checked against them
+                for result in self._run(
+                    expr,
+                    [pre, StrategySequence(*current_strategies)],
+                    [_Worklist(), _Worklist(graph._topological_order())],
+                    label=label,
+                ):
+                    replaced = True
+                    yield result
+
+            for result in self._run(
+                expr,
+                [StrategySequence(*normalize.post)],
+                [_Worklist(graph._topological_order())],
+                label="post",
+                once=True,
+            ):
+                replaced = True
+                yield result
+            if not replaced:
+                return
+        raise RuntimeError("Exceeded maximum number of repitions")
+
+    def _run(
+        self,
+        expr: ExpressionReference,
+        strategies: typing.List[Strategy],
+        worklists: typing.List[_Worklist],
+        label: str = "pre",
+        once: bool = False,
+    ) -> typing.Iterable[Result]:
+        """
+        Checks the nodes in the worklists against their strategies until they are all empty,
+        always taking the first non empty worklist.
+
+        If `once` is true, returns after the first replacement.
+        """
+        graph = expr._graph
+        misses = MissCache.of(expr)
+        n_replaced = 0
+        with profile_phase(label):
+            while True:
+                for strategy, worklist in zip(strategies, worklists):
+                    node = worklist.pop(graph)
+                    if node is not None:
+                        break
+                else:
+                    break
+                ref = ExpressionReference(
+                    graph, None if node == graph._root_index else node
+                )
+                uncacheable = misses.uncacheable
+                replaced = False
+                for result in strategy(ref):
+                    replaced = True
+                    yield result
+                if not replaced:
+                    if misses.uncacheable != uncacheable:
+                        worklist.defer(node)
+                    continue
+                n_replaced += 1
+                if once:
+                    break
+                if n_replaced >= self.max_calls:
+                    raise RuntimeError("Exceeded maximum number of repitions")
+                for worklist in worklists:
+                    worklist.retry()
+                    worklist.extend(graph._last_affected)
+        if n_replaced:
+            yield Result(name=label, label=label)
+
+    def optimize(self, executor, strategy):
+        self.normalize.optimize(executor, strategy)
+
+
+def execute_worklist(ref: ExpressionReference, strategy: Strategy) -> object:
+    """
+    Executes a strategy like the default `Executor.execute`, but runs a `StrategyNormalize`
+    with worklists. Other strategies are executed as is.
+
+    >>> executor = Executor(StrategyNormalize(), execute_worklist)
+    """
+    if isinstance(strategy, StrategyNormalize):
+        strategy = StrategyWorklist(strategy)
+    for _ in strategy(ref):
+        pass
+    return ref.expression
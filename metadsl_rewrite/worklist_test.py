@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import dataclasses
+import typing
+
+import pytest
+
+from metadsl import *
+
+from . import *
+from .testing import *
+
+
+@dataclasses.dataclass(eq=False)
+class _Count(Strategy):
+    """
+    Counts the nodes an inner strategy is called on.
+    """
+
+    strategy: Strategy
+    calls: typing.List[object] = dataclasses.field(default_factory=list)
+
+    def __call__(self, ref: ExpressionReference) -> typing.Iterable[Result]:
+        self.calls.append(ref.expression)
+        return self.strategy(ref)
+
+    def optimize(self, executor, strategy):
+        pass
+
+
+def _sum(n: int) -> Number:
+    expr = from_int(0)
+    for i in range(1, n):
+        expr = expr + from_int(i)
+    return expr
+
+
+class TestStrategyWorklist:
+    def test_phases(self):
+        normalize = StrategyNormalize()
+        normalize.phases["double"].add(double_rule)
+        normalize.phases["add"].add(add_rule)
+        expr = from_int(1).double().double()
+
+        ref = ExpressionReference.from_expression(expr)
+        labels = [
+            result.label for result in StrategyWorklist(normalize)(ref) if result.label
+        ]
+        assert ref.expression == from_int(4)
+        assert labels == ["double", "add"]
+        assert execute_worklist(
+            ExpressionReference.from_expression(expr), normalize
+        ) == Executor(normalize)(expr)
+
+    def test_pre(self):
+        """
+        Strategies in pre should be applied before those in the phase, whenever they match
+        """
+        normalize = StrategyNormalize()
+        normalize.pre.add(add_rule)
+        normalize.phases["double"].add(double_rule)
+        names = [
+            result.name
+            for result in StrategyWorklist(normalize)(
+                ExpressionReference.from_expression(from_int(1).double().double())
+            )
+        ]
+        assert names == [
+            str(double_rule),
+            str(add_rule),
+            str(double_rule),
+            str(add_rule),
+            "double",
+        ]
+
+    def test_checks_changed_nodes(self):
+        n = 50
+        add = _Count(add_rule)
+        normalize = StrategyNormalize()
+        normalize.phases["add"].add(add)
+
+        ref = ExpressionReference.from_expression(_sum(n))
+        list(StrategyWorklist(normalize)(ref))
+        assert ref.expression == from_int(sum(range(n)))
+        # Each replacement only adds a few nodes to check, instead of the whole graph
+        assert len(add.calls) < 10 * n
+
+    def test_outside_state(self):
+        """
+        Nodes that didn't match because of other state should be checked again
+        """
+        fired: typing.List[str] = []
+
+        @rule
+        def first() -> R[Number]:
+            def inner():
+                fired.append("first")
+                return from_int(1)
+
+            return from_int(0).double(), inner
+
+        @rule
+        def second() -> R[Number]:
+            def inner():
+                if not fired:
+                    raise NoMatch
+                return from_int(2)
+
+            return from_int(1).double(), inner
+
+        normalize = StrategyNormalize()
+        normalize.phases["double"].update([first, second])
+        ref = ExpressionReference.from_expression(
+            from_int(0).double() + from_int(1).double()
+        )
+        labels = [
+            result.label for result in StrategyWorklist(normalize)(ref) if result.label
+        ]
+        assert ref.expression == from_int(1) + from_int(2)
+        # Both are replaced in the first pass through the phase
+        assert labels == ["double"]
+
+    def test_max_calls(self):
+        normalize = StrategyNormalize()
+        normalize.phases["add"].add(add_rule)
+        ref = ExpressionReference.from_expression(_sum(20))
+        with pytest.raises(RuntimeError):
+            list(StrategyWorklist(normalize, max_calls=10)(ref))
@@ -13,11 +13,9 @@ import types
 import typing
 import warnings
 
-import black
 import typing_inspect
 
 import metadsl
-from metadsl.normalized import Graph, Hash
 from metadsl.typing_tools import BoundInfer, Infer
 from metadsl_rewrite import *
 from typez import *
@@ -85,9 +83,6 @@ class ExpressionDisplay:
         self.typez_display._ipython_display_()
 
 
-black_file_mode = black.FileMode(line_length=40)
-
-
 def expression_ref_to_typez(
     ref: metadsl.ExpressionReference, save_pickle=False
 ) -> Typez:
@@ -103,6 +98,9 @@ def convert_to_nodes(ref: metadsl.ExpressionReference, save_pickle=False) -> Nod
     """
     Converts an expression into a node mapping.
     """
+    import black
+
+    black_file_mode = black.FileMode(line_length=40)
     nodes: Nodes = []
     for ref in ref.descendents:
         node: typing.Union[CallNode, PrimitiveNode]
@@ -180,7 +178,8 @@ def json_value_to_expr(value: dict) -> metadsl.Expression:
     Converts a JSON value to an expression.
     """
     typez = Typez.from_dict(value)
-    graph = Graph()
+    # Mapping of node ids to the expressions created for them
+    expressions: typing.Dict[str, object] = {}
     assert typez.nodes
     for node in typez.nodes:
         if isinstance(node, PrimitiveNode):
@@ -190,15 +189,12 @@ def json_value_to_expr(value: dict) -> metadsl.Expression:
             expression = type_instance_to_type(node.type)(
                 # TODO: replace typevars as well
                 function=function_value_to_fn(node.function_value),
-                args=[graph._lookup(Hash(a))["expression"] for a in node.args or []],
-                kwargs={
-                    k: graph._lookup(Hash(v))["expression"]
-                    for k, v in (node.kwargs or {}).items()
-                },
+                args=[expressions[a] for a in node.args or []],
+                kwargs={k: expressions[v] for k, v in (node.kwargs or {}).items()},
             )
-        graph.add_vertex(expression=expression, name=node.id)
+        expressions[node.id] = expression
     assert typez.states
-    return graph._lookup(Hash(typez.states.initial))["expression"]
+    return typing.cast(metadsl.Expression, expressions[typez.states.initial])
 
 
 def type_instance_to_type(type_instance: TypeInstance) -> type:
@@ -1,8 +1,6 @@
+import sys
 import typing
 
-import IPython
-import IPython.core.display
-
 from metadsl import *
 from metadsl_rewrite import *
 
@@ -18,6 +16,9 @@ def execute_and_visualize(ref: ExpressionReference, strategy: Strategy) -> objec
     """
     Returns the replaced version of this expression and also displays the execution trace.
     """
+    import IPython
+    import IPython.core.display
+
     expression_display = ExpressionDisplay(ref)
 
     # Only display expressions if in notebook, not in shell
@@ -37,8 +38,9 @@ def monkeypatch():
     """
     Monkeypatches execute so that it also displays each step
     """
-    # only change if we are in a kernel
-    if IPython.get_ipython():
+    # only change if we are in a kernel, which has already imported IPython
+    IPython = sys.modules.get("IPython")
+    if IPython and IPython.get_ipython():
         execute.execute = execute_and_visualize  # type: ignore
 
 
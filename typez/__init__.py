@@ -7,10 +7,10 @@ import dataclasses
 import json
 import pathlib
 from dataclasses import dataclass
-from typing import Dict, ItemsView, List, Optional, Set, Tuple, Union
+from typing import TYPE_CHECKING, Dict, ItemsView, List, Optional, Set, Tuple, Union
 
-import IPython.core.display
-import jsonschema
+if TYPE_CHECKING:
+    import IPython.core.display
 
 __all__ = [
     "Typez",
@@ -303,6 +303,8 @@ class TypezDisplay:
     )
 
     def _ipython_display_(self):
+        import IPython.core.display
+
         self._handle = IPython.core.display.display(self.typez, display_id=True)
 
     @property  # type: ignore